@@ -0,0 +1,309 @@
+# bench_labels.py — benchmark cho generate_labels_all (offline, dữ liệu tổng hợp)
+#   python bench_labels.py [--sizes=10,1000] [--large] [--pages=100] [--repeat=3] [--only=find,render,...]
+#                          [--out=bench_results.jsonl]
+#   --large thêm kích thước LARGE_SIZE (100k tem qua mọi backend/encoding: chạy rất lâu)
+#   python bench_labels.py 2000        (chỉ 1 kích thước)
+# Mỗi lần chạy ghi thêm 1 dòng JSON / phép đo vào --out để so sánh giữa các phiên bản.
+import os, io, sys, json, time, shutil, platform, tempfile, subprocess, contextlib
+import PIL.Image as PilImage
+import fitz  # PyMuPDF
+import pandas as pd
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+
+import generate_labels_all as gla
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FILE = os.path.join(HERE, 'bench_results.jsonl')
+DEFAULT_SIZES = (10, 1000)
+LARGE_SIZE = 100000
+LEGACY_MAX_LABELS = 10000   # the per-label writer is only worth timing on small chunks
+BENCHES = ('find', 'render', 'colorlabel', 'backend', 'vector', 'encoding', 'hangtag', 'columnize', 'cli')
+
+def synthetic_label_img(dpi=gla.DEFAULT_DPI):
+    px_per_mm = dpi / 25.4
+    w = int((210 - gla.CROP_RED['left'] - gla.CROP_RED['right']) * px_per_mm)
+    h = int((297 - gla.CROP_RED['top'] - gla.CROP_RED['bottom']) * px_per_mm)
+    img = PilImage.linear_gradient('L').resize((w, h)).convert('RGB')
+    return img
+
+def synthetic_codes(n_pages):
+    return [f'C{207000 + i}' for i in range(n_pages)]
+
+def synthetic_label_pdf(path, n_pages, week='W42'):
+    # One A4 page per code, laid out like the customer's label sheet: the code above the crop box,
+    # the week / MER- line and some coloured artwork inside it.
+    doc = fitz.open()
+    top, left = gla.CROP_RED['top'] * 72 / 25.4, gla.CROP_RED['left'] * 72 / 25.4
+    for i, code in enumerate(synthetic_codes(n_pages)):
+        page = doc.new_page(width=595.28, height=841.89)
+        page.insert_text((40, 60), f'PO 45000{i:05d}  ITEM {code}', fontsize=11)
+        page.insert_text((40, 80), f'Ma SP doi tac: {code}', fontsize=9)
+        box = fitz.Rect(left, top, 595.28 - gla.CROP_RED['right'] * 72 / 25.4, top + 180)
+        page.draw_rect(box, color=(1, 0, 0), fill=(1, 0.93, 0.9), width=1.5)
+        for k in range(6):
+            page.draw_circle(fitz.Point(box.x0 + 30 + k * 35, box.y0 + 60), 12,
+                             color=(0.8, 0.1, 0.1), fill=((k % 3) / 3, 0.3, 0.6))
+        page.insert_text((box.x0 + 10, box.y0 + 20), f'MER-{code}-{week}', fontsize=10)
+        page.insert_text((box.x0 + 10, box.y0 + 110), f'{week}/2026  COLOR {i % 17:02d}', fontsize=9)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+    return path
+
+def synthetic_orders(codes, n_labels, qty=12):
+    # n_labels spread over the codes (at least one per code), one Excel row per code
+    codes = codes[:max(1, min(len(codes), n_labels))]
+    per, extra = divmod(n_labels, len(codes))
+    rows = []
+    for i, code in enumerate(codes):
+        labels = per + (1 if i < extra else 0)
+        rows.append({'Mã SP đối tác': code, 'QTY': str(qty), 'Số lượng': labels * qty,
+                     'SL Tổng': labels * qty, 'LSX': f'LSX{i:04d}'})
+    return pd.DataFrame(rows)
+
+def synthetic_orders_xlsx(path, codes, n_labels, qty=12):
+    synthetic_orders(codes, n_labels, qty).to_excel(path, index=False)
+    return path
+
+def legacy_export_chunk_colorlabel(code, qty_val, jpeg, start_n, end_n, total_display, out_path):
+    # Per-label writer as it was before the label form: image + border + font set on every label.
+    img_reader = ImageReader(io.BytesIO(jpeg))
+    font_name = gla.try_register_font(gla.RED_FONT_FILE, gla.RED_FONT_NAME, fallback='Helvetica')
+    page_w, page_h = landscape(A4)
+    label_w_pt = gla.LABEL_W_MM * mm
+    label_h_pt = gla.LABEL_H_MM * mm
+    positions = gla.label_positions(page_w, page_h)
+    c = canvas.Canvas(out_path, pagesize=landscape(A4))
+    for row in gla.columnize_rows(start_n, end_n):
+        for pos_idx, cur in enumerate(row):
+            if cur is None: continue
+            x, y = positions[pos_idx]
+            c.drawImage(img_reader, x, y, width=label_w_pt, height=label_h_pt)
+            c.setStrokeColorRGB(1, 0, 0); c.setLineWidth(1); c.rect(x, y, label_w_pt, label_h_pt, stroke=1, fill=0)
+            c.setFillColorRGB(0, 0, 0); c.setFont(font_name, gla.RED_TEXT_SIZE_PT)
+            (bx_pt, by_pt), (qx_pt, qy_pt) = gla.label_text_points(x, y)
+            c.drawCentredString(bx_pt, by_pt, f"{gla.fmt_min2(cur)}/{total_display}")
+            c.drawCentredString(qx_pt, qy_pt, f"{int(qty_val):02d}")
+        c.showPage()
+    c.save()
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def timed(fn, repeat=3, setup=None):
+    # best of `repeat`; setup() runs untimed before each call
+    best = None
+    for _ in range(repeat):
+        if setup: setup()
+        t0 = time.perf_counter(); fn(); dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+def bench_find(pdf_path, codes, repeat=3):
+    # text index build + one lookup per code, on a freshly opened document each time
+    state = {}
+    def setup():
+        if 'doc' in state: gla.close_pdf(state['doc'])
+        gla._PAGE_INDEXES.clear(); state['doc'] = fitz.open(pdf_path)
+    def run():
+        for code in codes: gla.find_page_by_code(state['doc'], code)
+    dt = timed(run, repeat, setup)
+    gla.close_pdf(state['doc'])
+    return dict(name='find_page_by_code', seconds=dt, pages=len(codes), per_lookup_ms=dt * 1000 / len(codes))
+
+def bench_render(pdf_path, dpi=gla.DEFAULT_DPI, repeat=3):
+    with fitz.open(pdf_path) as doc:
+        page = doc[0]
+        full = timed(lambda: gla.crop_region(gla.render_full_page(page, dpi), gla.CROP_RED, dpi), repeat)
+        clip = timed(lambda: gla.render_label_region(page, dpi), repeat)
+        img = gla.render_label_region(page, dpi)
+    enc = timed(lambda: gla.encode_label_jpeg(img), repeat)
+    return [dict(name='render_full_page+crop_region', seconds=full, dpi=dpi),
+            dict(name='render_label_region', seconds=clip, dpi=dpi),
+            dict(name='encode_label_jpeg', seconds=enc, dpi=dpi, bytes=len(gla.encode_label_jpeg(img)))]
+
+def bench_colorlabel(n_labels=2000, repeat=3):
+    jpeg = gla.encode_label_jpeg(synthetic_label_img())
+    pages = -(-n_labels // 4)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_labels_') as out_dir, quiet():
+        legacy_path = os.path.join(out_dir, 'legacy.pdf')
+        form_path = os.path.join(out_dir, gla.colorlabel_filename('C000000', 1, n_labels, 'BENCH'))
+        if n_labels <= LEGACY_MAX_LABELS:
+            dt = timed(lambda: legacy_export_chunk_colorlabel('C000000', 12, jpeg, 1, n_labels, n_labels, legacy_path), repeat)
+            results.append(dict(name='colorlabel_legacy', seconds=dt, pages=pages,
+                                bytes=os.path.getsize(legacy_path)))
+        dt = timed(lambda: gla.export_chunk_colorlabel('C000000', 12, jpeg, gla.DEFAULT_DPI, 1, n_labels, n_labels,
+                                                       'BENCH', out_dir), repeat)
+        results.append(dict(name='export_chunk_colorlabel', seconds=dt, pages=pages, bytes=os.path.getsize(form_path)))
+    return results
+
+def bench_backends(n_labels=2000, repeat=3):
+    # the same ColorLabel chunk and Hangtag sheet through each output backend
+    jpeg = gla.encode_label_jpeg(synthetic_label_img())
+    pages = gla.label_page_count(1, n_labels)
+    results = []
+    with quiet():
+        for backend in gla.OUTPUT_BACKENDS:
+            with tempfile.TemporaryDirectory(prefix=f'bench_{backend}_') as out_dir:
+                if backend == 'fitz':
+                    write = lambda: gla.export_chunk_colorlabel_fitz('C000000', 12, jpeg, 1, n_labels, n_labels, 'BENCH',
+                                                                     out_dir)
+                else:
+                    write = lambda: gla.export_chunk_colorlabel('C000000', 12, jpeg, gla.DEFAULT_DPI, 1, n_labels, n_labels,
+                                                                'BENCH', out_dir)
+                dt = timed(write, repeat)
+                path = os.path.join(out_dir, gla.colorlabel_filename('C000000', 1, n_labels, 'BENCH'))
+                results.append(dict(name=f'colorlabel_{backend}', seconds=dt, pages=pages, bytes=os.path.getsize(path)))
+                dt = timed(lambda: gla.export_hangtag_generated('C207000', 'MER-C207000-W42', out_dir, backend=backend),
+                           repeat, setup=gla._HANGTAG_INPUTS.clear)
+                path = os.path.join(out_dir, gla.hangtag_filename('C207000'))
+                results.append(dict(name=f'hangtag_{backend}', seconds=dt, pages=1, bytes=os.path.getsize(path)))
+    return results
+
+def bench_vector(pdf_path, n_labels=2000, repeat=3):
+    # one ColorLabel chunk from a real source page: raster (crop render + JPEG + reportlab / fitz writer)
+    # against vector (the CROP_RED region grafted as a form); the raster times include the render
+    doc = fitz.open(pdf_path)
+    pages = gla.label_page_count(1, n_labels)
+    raster = lambda: gla.encode_label_jpeg(gla.render_label_region(doc[0], gla.DEFAULT_DPI))
+    writers = {
+        'raster_reportlab': lambda out_dir: gla.export_chunk_colorlabel('C207000', 12, raster(), gla.DEFAULT_DPI, 1, n_labels,
+                                                                        n_labels, 'BENCH', out_dir),
+        'raster_fitz': lambda out_dir: gla.export_chunk_colorlabel_fitz('C207000', 12, raster(), 1, n_labels, n_labels,
+                                                                        'BENCH', out_dir),
+        'vector_fitz': lambda out_dir: gla.export_chunk_colorlabel_fitz('C207000', 12, (doc, 0), 1, n_labels, n_labels,
+                                                                        'BENCH', out_dir),
+    }
+    results = []
+    with quiet():
+        for name, write in writers.items():
+            with tempfile.TemporaryDirectory(prefix=f'bench_{name}_') as out_dir:
+                dt = timed(lambda: write(out_dir), repeat)
+                path = os.path.join(out_dir, gla.colorlabel_filename('C207000', 1, n_labels, 'BENCH'))
+                results.append(dict(name=f'colorlabel_{name}', seconds=dt, pages=pages, bytes=os.path.getsize(path)))
+    doc.close()
+    return results
+
+def bench_encoding(pdf_path, n_labels=2000, repeat=3):
+    # every encoding profile: label image encode time/bytes, then a ColorLabel chunk and a Hangtag sheet per backend
+    doc = fitz.open(pdf_path)
+    pages = gla.label_page_count(1, n_labels)
+    results = []
+    with quiet():
+        for name, prof in gla.ENCODE_PROFILES.items():
+            img = gla.render_label_region(doc[0], prof['dpi'])
+            enc = timed(lambda: gla.encode_label_jpeg(img, name), repeat)
+            image = gla.encode_label_jpeg(img, name)
+            results.append(dict(name=f'encode_{name}', seconds=enc, dpi=prof['dpi'], bytes=len(image)))
+            for backend in gla.OUTPUT_BACKENDS:
+                with tempfile.TemporaryDirectory(prefix=f'bench_{name}_{backend}_') as out_dir:
+                    if backend == 'fitz':
+                        write = lambda: gla.export_chunk_colorlabel_fitz('C000000', 12, image, 1, n_labels, n_labels,
+                                                                         'BENCH', out_dir, encoding=name)
+                    else:
+                        write = lambda: gla.export_chunk_colorlabel('C000000', 12, image, prof['dpi'], 1, n_labels,
+                                                                    n_labels, 'BENCH', out_dir, encoding=name)
+                    dt = timed(write, repeat)
+                    path = os.path.join(out_dir, gla.colorlabel_filename('C000000', 1, n_labels, 'BENCH'))
+                    results.append(dict(name=f'colorlabel_{name}_{backend}', seconds=dt, pages=pages,
+                                        bytes=os.path.getsize(path)))
+                    dt = timed(lambda: gla.export_hangtag_generated('C207000', 'MER-C207000-W42', out_dir, backend=backend,
+                                                                    encoding=name), repeat, setup=gla._HANGTAG_INPUTS.clear)
+                    path = os.path.join(out_dir, gla.hangtag_filename('C207000'))
+                    results.append(dict(name=f'hangtag_{name}_{backend}', seconds=dt, pages=1,
+                                        bytes=os.path.getsize(path)))
+    doc.close()
+    return results
+
+def bench_hangtag(repeat=3):
+    with tempfile.TemporaryDirectory(prefix='bench_hangtag_') as out_dir:
+        with quiet():
+            # the writer skips unchanged (code, week) sheets; clear that memo so every call really writes
+            dt = timed(lambda: gla.export_hangtag_generated('C207000', 'MER-C207000-W42', out_dir), repeat,
+                       setup=gla._HANGTAG_INPUTS.clear)
+        path = os.path.join(out_dir, gla.hangtag_filename('C207000'))
+        return dict(name='export_hangtag_generated', seconds=dt, bytes=os.path.getsize(path))
+
+def bench_columnize(n_labels, repeat=3):
+    dt = timed(lambda: sum(1 for _ in gla.columnize_rows(1, n_labels)), repeat)
+    return dict(name='columnize_rows', seconds=dt)
+
+def bench_cli(pdf_path, codes, n_labels, dpi=gla.DEFAULT_DPI, repeat=1):
+    # whole CLI in a fresh interpreter, output into a scratch folder
+    with tempfile.TemporaryDirectory(prefix='bench_cli_') as work:
+        xlsx = synthetic_orders_xlsx(os.path.join(work, 'orders.xlsx'), codes, n_labels)
+        # the CLI looks for its fonts in the working directory; without them it silently falls back to Helvetica
+        for font in (gla.RED_FONT_FILE, 'Sansation_Bold.ttf'):
+            shutil.copy(os.path.join(HERE, font), work)
+        cmd = [sys.executable, os.path.join(HERE, 'generate_labels_all.py'), xlsx, pdf_path, str(dpi), '--export=both']
+        env = dict(os.environ, PYTHONIOENCODING='utf-8')
+        def run():
+            subprocess.run(cmd, cwd=work, env=env, check=True, stdout=subprocess.DEVNULL)
+        dt = timed(run, repeat)
+        out = os.path.join(work, gla.OUTPUT_DIR)
+        files = [os.path.join(d, f) for d, _, fs in os.walk(out) for f in fs if f.endswith('.pdf')]
+        return dict(name='cli_end_to_end', seconds=dt, files=len(files), bytes=sum(os.path.getsize(f) for f in files))
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def record(results, path=RESULTS_FILE):
+    # append-only JSONL: one line per measurement, tagged with version/commit/machine
+    meta = dict(ts=time.strftime('%Y-%m-%dT%H:%M:%S'), version=gla.VERSION, commit=git_revision(),
+                python=platform.python_version(), machine=platform.node(), platform=platform.platform())
+    with open(path, 'a', encoding='utf-8') as f:
+        for r in results:
+            f.write(json.dumps(dict(meta, **r), ensure_ascii=False) + '\n')
+    return path
+
+def run_suite(sizes=DEFAULT_SIZES, n_pages=100, repeat=3, only=BENCHES, out=RESULTS_FILE):
+    # every bench writes into its own temporary folder, removed as soon as its numbers are taken
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_suite_') as work:
+        pdf_path = synthetic_label_pdf(os.path.join(work, 'labels.pdf'), n_pages)
+        codes = synthetic_codes(n_pages)
+        if 'find' in only: results.append(bench_find(pdf_path, codes, repeat))
+        if 'render' in only: results.extend(bench_render(pdf_path, repeat=repeat))
+        if 'hangtag' in only: results.append(bench_hangtag(repeat))
+        for n in sizes:
+            sized = []
+            if 'columnize' in only: sized.append(bench_columnize(n, repeat))
+            if 'colorlabel' in only: sized.extend(bench_colorlabel(n, repeat))
+            if 'backend' in only: sized.extend(bench_backends(n, repeat))
+            if 'vector' in only: sized.extend(bench_vector(pdf_path, n, repeat))
+            if 'encoding' in only: sized.extend(bench_encoding(pdf_path, n, repeat))
+            if 'cli' in only: sized.append(bench_cli(pdf_path, codes, n))
+            for r in sized: r['labels'] = n
+            results.extend(sized)
+    for r in results:
+        extra = '  '.join(f'{k}={v}' for k, v in r.items() if k not in ('name', 'seconds'))
+        pps = f"  {r['pages']/r['seconds']:8.1f} trang/s" if r.get('pages') and r['seconds'] else ''
+        print(f"  {r['name']:<30} {r['seconds']*1000:10.2f} ms{pps}  {extra}")
+    if out:
+        print(f'[OK] {len(results)} ket qua -> {record(results, out)}')
+    return results
+
+def main(argv):
+    sizes, n_pages, repeat, only, out = DEFAULT_SIZES, 100, 3, BENCHES, RESULTS_FILE
+    for a in argv:
+        if a.startswith('--sizes='): sizes = [int(v) for v in a.split('=', 1)[1].split(',') if v.strip()]
+        elif a.startswith('--pages='): n_pages = max(1, int(a.split('=', 1)[1]))
+        elif a.startswith('--repeat='): repeat = max(1, int(a.split('=', 1)[1]))
+        elif a.startswith('--only='): only = tuple(v.strip() for v in a.split('=', 1)[1].split(','))
+        elif a.startswith('--out='): out = a.split('=', 1)[1].strip() or None
+        elif a.isdigit(): sizes = [int(a)]
+    if '--large' in argv: sizes = list(sizes) + [LARGE_SIZE]
+    print(f'Benchmark v{gla.VERSION}: sizes={list(sizes)} pages={n_pages} repeat={repeat} only={",".join(only)}')
+    return run_suite(sizes, n_pages, repeat, only, out)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
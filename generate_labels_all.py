@@ -1,6 +1,7 @@
 # generate_labels_all.py — v2.12.5
-import os, io, re, sys, glob
+import os, io, re, sys, glob, json, time, hashlib, threading, contextlib
 import fitz  # PyMuPDF
+import numpy as np
 import pandas as pd
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4, landscape
@@ -25,10 +26,24 @@ _force_utf8()
 os.environ["PYTHONUTF8"] = "1"
 os.environ["PYTHONIOENCODING"] = "utf-8"
 
+VERSION = '2.12.5'
 OUTPUT_DIR = "output_pdfs"
 DEFAULT_SPLIT = 500
 DEFAULT_DPI = 150
 
+# Encoding profiles: raster DPI, JPEG quality, colour ('rgb' | 'gray' | 'indexed' = palette PNG of
+# `colors` entries), PDF stream compression and font subsetting. 'print' is the historical output.
+ENCODE_PROFILES = {
+    'draft':   dict(dpi=100, quality=60, color='gray', colors=0, compress=True, subset=True),
+    'print':   dict(dpi=DEFAULT_DPI, quality=85, color='rgb', colors=0, compress=True, subset=True),
+    'flat':    dict(dpi=DEFAULT_DPI, quality=85, color='indexed', colors=64, compress=True, subset=True),
+    'archive': dict(dpi=300, quality=95, color='rgb', colors=0, compress=True, subset=False),
+}
+DEFAULT_PROFILE = 'print'
+
+def encode_profile(name):
+    return ENCODE_PROFILES.get(name) or ENCODE_PROFILES[DEFAULT_PROFILE]
+
 CROP_RED = dict(top=65.5, bottom=132, left=43, right=17)  # mm
 REF_W, REF_H = 1155, 768
 BOX_REF = (760, 585)
@@ -49,8 +64,8 @@ BARSCALE_H_MM    = 7
 def ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
 
-def code_outdir(code: str) -> str:
-    folder = os.path.join(OUTPUT_DIR, re.sub(r'[^A-Z0-9]', '', str(code).upper()))
+def code_outdir(code: str, root: str = None) -> str:
+    folder = os.path.join(root or OUTPUT_DIR, re.sub(r'[^A-Z0-9]', '', str(code).upper()))
     ensure_dir(folder)
     return folder
 
@@ -60,12 +75,128 @@ def sanitize_for_filename(s: str) -> str:
     s = re.sub(r'[^A-Za-z0-9._-]+', '-', s)
     return s if s else 'LSX'
 
+class RunStats:
+    # Stage timers and counters for one run; generate() installs it for its thread.
+    def __init__(self):
+        self.stages = {}    # name -> [seconds, calls]
+        self.counters = {}
+        self.peaks = {}
+
+    def add(self, name, seconds, calls=1):
+        st = self.stages.setdefault(name, [0.0, 0])
+        st[0] += seconds; st[1] += calls
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def peak(self, name, value):
+        if value is not None: self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def merge(self, data):
+        # data: as_dict() of a worker process
+        for name, st in data['stages'].items(): self.add(name, st['seconds'], st['calls'])
+        for name, n in data['counters'].items(): self.count(name, n)
+        for name, v in data['peaks'].items(): self.peak(name, v)
+
+    def as_dict(self):
+        return dict(stages={k: dict(seconds=round(v[0], 4), calls=v[1]) for k, v in self.stages.items()},
+                    counters=dict(self.counters), peaks=dict(self.peaks))
+
+_RUN_STATS = threading.local()
+
+def current_stats():
+    return getattr(_RUN_STATS, 'stats', None)
+
+@contextlib.contextmanager
+def collect_stats(stats):
+    prev = current_stats(); _RUN_STATS.stats = stats
+    try: yield stats
+    finally: _RUN_STATS.stats = prev
+
+@contextlib.contextmanager
+def run_stage(name):
+    stats = current_stats()
+    if stats is None:
+        yield; return
+    t0 = time.perf_counter()
+    try: yield
+    finally: stats.add(name, time.perf_counter() - t0)
+
+def run_count(name, n=1):
+    stats = current_stats()
+    if stats is not None: stats.count(name, n)
+
+def count_output(path, labels=0):
+    # one finished PDF on disk
+    run_count('files_written'); run_count('labels_drawn', labels)
+    try: run_count('bytes_written', os.path.getsize(path))
+    except OSError: pass
+
+def peak_rss_mb():
+    # peak resident set size of this process; None where neither resource nor psutil is available
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / 1048576, 1)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1048576 if sys.platform == 'darwin' else 1024), 1)
+
 def render_full_page(page, dpi=DEFAULT_DPI):
     import PIL.Image as PilImage
     mat = fitz.Matrix(dpi/72, dpi/72)
     pix = page.get_pixmap(matrix=mat, alpha=False)
     return PilImage.open(io.BytesIO(pix.tobytes('png'))).convert('RGB')
 
+def crop_rect(page, crop_conf=CROP_RED):
+    mm2pt = 72/25.4
+    return fitz.Rect(
+        crop_conf['left']*mm2pt,
+        crop_conf['top']*mm2pt,
+        page.rect.width - crop_conf['right']*mm2pt,
+        page.rect.height - crop_conf['bottom']*mm2pt
+    )
+
+def render_label_region(page, dpi=DEFAULT_DPI, crop_conf=CROP_RED):
+    import PIL.Image as PilImage
+    with run_stage('render'):
+        mat = fitz.Matrix(dpi/72, dpi/72)
+        pix = page.get_pixmap(matrix=mat, clip=crop_rect(page, crop_conf), alpha=False)
+        return PilImage.frombytes('RGB', (pix.width, pix.height), pix.samples)
+
+def encode_label_jpeg(img, encoding=DEFAULT_PROFILE) -> bytes:
+    # JPEG, or a palette PNG for 'indexed' profiles; both writers take either as-is
+    prof = encode_profile(encoding)
+    buf_img = io.BytesIO()
+    with run_stage('encode'):
+        if prof['color'] == 'indexed':
+            import PIL.Image as PilImage
+            img = img.convert('P', palette=PilImage.ADAPTIVE, colors=prof['colors'])
+            img.save(buf_img, format='PNG', optimize=True)
+        else:
+            if prof['color'] == 'gray': img = img.convert('L')
+            img.save(buf_img, format='JPEG', quality=prof['quality'], optimize=True)
+    return buf_img.getvalue()
+
+def pdf_canvas(out_path, encoding=DEFAULT_PROFILE):
+    # reportlab always subsets TTF fonts, so only compression follows the profile here
+    return canvas.Canvas(out_path, pagesize=landscape(A4), pageCompression=int(encode_profile(encoding)['compress']))
+
+def save_fitz(doc, out_path, encoding=DEFAULT_PROFILE, fonts=()):
+    # fonts: the fitz_doc_font()s used by fitz_text, whose ToUnicode maps are written here
+    prof = encode_profile(encoding)
+    if prof['subset']:
+        try: doc.subset_fonts()
+        except Exception: pass   # older PyMuPDF needs fontTools for this; the full fonts stay embedded
+    for font in fonts: fitz_font_unicode(doc, font)
+    # garbage=2 drops the scratch pages' leftovers and compacts; 3 (merge duplicates) is quadratic in the
+    # object count and costs seconds on a few thousand pages without finding anything to merge
+    doc.save(out_path, garbage=2, deflate=prof['compress'])
+
 def crop_region(img, crop_conf, dpi):
     px_per_mm = dpi / 25.4
     w, h = img.size
@@ -80,86 +211,120 @@ def fmt_min2(n: int) -> str:
     return f"{n:02d}" if n < 100 else str(n)
 
 def columnize_rows(start_n: int, end_n: int):
+    # Lazy 4-column layout: the range is cut into 4 stacked columns (the first `rem` one longer),
+    # and row r shows the r-th number of each column. Nothing is materialized.
     total = max(0, end_n - start_n + 1)
-    if total <= 0: return []
+    if total <= 0: return
     base, rem = divmod(total, 4)
-    sizes = [base + (1 if i < rem else 0) for i in range(4)]
-    cols = []; cur = start_n
-    for s in sizes:
-        cols.append(list(range(cur, cur + s))); cur += s
-    maxlen = max(len(c) for c in cols) if cols else 0
-    rows = []
-    for r in range(maxlen):
-        rows.append([
-            cols[0][r] if r < len(cols[0]) else None,
-            cols[1][r] if r < len(cols[1]) else None,
-            cols[2][r] if r < len(cols[2]) else None,
-            cols[3][r] if r < len(cols[3]) else None,
-        ])
-    return rows
+    firsts = [start_n + col * base + min(col, rem) for col in range(4)]
+    sizes = [base + (1 if col < rem else 0) for col in range(4)]
+    for r in range(sizes[0]):
+        yield [firsts[col] + r if r < sizes[col] else None for col in range(4)]
 
-def try_register_font(ttf_path: str, name: str = 'SansationBold') -> str:
-    try:
-        if os.path.exists(ttf_path):
-            pdfmetrics.registerFont(TTFont(name, ttf_path))
-            return name
-    except Exception:
-        pass
-    return 'Helvetica-Bold'
+def label_page_count(start_n: int, end_n: int) -> int:
+    return -(-max(0, end_n - start_n + 1) // 4)
 
-def draw_code39_on_canvas(c, value, x, y, cell_w, cell_h):
+_FONT_CACHE = {}
+
+def try_register_font(ttf_path: str, name: str = 'SansationBold', fallback: str = 'Helvetica-Bold') -> str:
+    # TTF parsing is the expensive part; do it once per process and font.
+    key = (ttf_path, name)
+    if key not in _FONT_CACHE:
+        _FONT_CACHE[key] = None
+        try:
+            if os.path.exists(ttf_path):
+                pdfmetrics.registerFont(TTFont(name, ttf_path))
+                _FONT_CACHE[key] = name
+        except Exception:
+            pass
+    return _FONT_CACHE[key] or fallback
+
+_BARCODES = {}
+
+def code39_barcode(value):
     from reportlab.lib.units import mm as _mm
     clean_val = re.sub(r'[^A-Z0-9]', '', str(value).upper())
+    if clean_val not in _BARCODES:
+        _BARCODES[clean_val] = code39.Standard39(clean_val, stop=1, checksum=0,
+                                                 barHeight=BARSCALE_H_MM*_mm, barWidth=0.25*_mm)
+    return _BARCODES[clean_val]
+
+def draw_code39_on_canvas(c, value, x, y, cell_w, cell_h):
+    from reportlab.lib.units import mm as _mm
     desired_w, desired_h = BARSCALE_W_MM*_mm, BARSCALE_H_MM*_mm
-    bc = code39.Standard39(clean_val, stop=1, checksum=0, barHeight=desired_h, barWidth=0.25*_mm)
+    bc = code39_barcode(value)
     scale_x = desired_w / bc.width
     bx = x + (cell_w - desired_w)/2.0
     by = y + (cell_h - desired_h)/2.0 - 5*_mm + 4*_mm
     c.saveState(); c.translate(bx, by); c.scale(scale_x, 1.0)
     bc.drawOn(c, 0, 0); c.restoreState()
 
-def export_hangtag_generated(code_text, week_text, out_dir):
-    ensure_dir(out_dir)
-    out_path = os.path.join(out_dir, f"{re.sub(r'[^A-Z0-9]', '', str(code_text).upper())}_Hangtag.pdf")
-    c = canvas.Canvas(out_path, pagesize=landscape(A4))
+HANGTAG_CELL_W, HANGTAG_CELL_H = 40 * mm, 30 * mm
+HANGTAG_FORM = 'HangtagCell'
 
-    page_w, page_h = landscape(A4)
-    cell_w, cell_h = 40 * mm, 30 * mm
+def hangtag_cells(page_w, page_h):
     spacing = 4 * mm
-    total_w = 6 * cell_w + 5 * spacing
-    total_h = 6 * cell_h + 5 * spacing
+    total_w = 6 * HANGTAG_CELL_W + 5 * spacing
+    total_h = 6 * HANGTAG_CELL_H + 5 * spacing
     offset_x = (page_w - total_w) / 2
     offset_y = (page_h - total_h) / 2
+    return [(offset_x + cidx * (HANGTAG_CELL_W + spacing), offset_y + r * (HANGTAG_CELL_H + spacing))
+            for r in range(6) for cidx in range(6)]
+
+def hangtag_filename(code_text):
+    return f"{re.sub(r'[^A-Z0-9]', '', str(code_text).upper())}_Hangtag.pdf"
 
-    font_name = try_register_font('Sansation_Bold.ttf', 'SansationBold')
-
-    for r in range(6):
-        for cidx in range(6):
-            x = offset_x + cidx * (cell_w + spacing)
-            y = offset_y + r * (cell_h + spacing)
-            c.setLineWidth(BLUE_BORDER_PT)
-            c.setStrokeColorRGB(0, 204/255, 1)
-            c.rect(x, y, cell_w, cell_h)
-            c.setFillColorRGB(0, 0, 0)
-            c.setFont(font_name, CODE_FONTSIZE_PT)
-            c.drawString(x + 3*mm, y + 4*mm, re.sub(r'[^A-Z0-9]', '', str(code_text).upper()))
-            c.setFont(font_name, WEEK_FONTSIZE_PT)
-            c.drawString(x + 3*mm, y + 1*mm, str(week_text))
-            draw_code39_on_canvas(c, code_text, x, y, cell_w, cell_h)
-
-    c.showPage(); c.save()
+def define_hangtag_form(c, code_text, week_text, font_name, name=HANGTAG_FORM):
+    cell_w, cell_h = HANGTAG_CELL_W, HANGTAG_CELL_H
+    pad = max(0, (BARSCALE_W_MM*mm - cell_w)/2) + 1   # the barcode is wider than the cell
+    c.beginForm(name, lowerx=-pad, lowery=-1, upperx=cell_w + pad, uppery=cell_h + 1)
+    c.setLineWidth(BLUE_BORDER_PT)
+    c.setStrokeColorRGB(0, 204/255, 1)
+    c.rect(0, 0, cell_w, cell_h)
+    c.setFillColorRGB(0, 0, 0)
+    c.setFont(font_name, CODE_FONTSIZE_PT)
+    c.drawString(3*mm, 4*mm, re.sub(r'[^A-Z0-9]', '', str(code_text).upper()))
+    c.setFont(font_name, WEEK_FONTSIZE_PT)
+    c.drawString(3*mm, 1*mm, str(week_text))
+    draw_code39_on_canvas(c, code_text, 0, 0, cell_w, cell_h)
+    c.endForm()
+
+_HANGTAG_INPUTS = {}
+
+def export_hangtag_generated(code_text, week_text, out_dir, backend='reportlab', encoding=DEFAULT_PROFILE):
+    ensure_dir(out_dir)
+    out_path = os.path.join(out_dir, hangtag_filename(code_text))
+    inputs = (re.sub(r'[^A-Z0-9]', '', str(code_text).upper()), str(week_text), backend, encoding)
+    if _HANGTAG_INPUTS.get(out_path) == inputs and os.path.exists(out_path):
+        return out_path
+    if backend == 'fitz':
+        with run_stage('hangtag'):
+            out = fitz.open(); font = fitz_doc_font(out, 'Sansation_Bold.ttf', 'SansationBold')
+            draw_hangtag_page_fitz(out, fitz_hangtag_form(out, code_text, week_text, font))
+        with run_stage('save'):
+            save_fitz(out, out_path, encoding, fonts=[font])
+            out.close()
+    else:
+        with run_stage('hangtag'):
+            c = pdf_canvas(out_path, encoding)
+            font_name = try_register_font('Sansation_Bold.ttf', 'SansationBold')
+            define_hangtag_form(c, code_text, week_text, font_name)
+            draw_hangtag_page(c)
+        with run_stage('save'):
+            c.save()
+    count_output(out_path)
+    _HANGTAG_INPUTS[out_path] = inputs
     print(f"[OK] Hangtag -> {os.path.basename(out_path)}")
+    return out_path
 
-def extract_week_text(doc, page_idx):
+def draw_hangtag_page(c, form_name=HANGTAG_FORM):
+    for x, y in hangtag_cells(*landscape(A4)):
+        c.saveState(); c.translate(x, y); c.doForm(form_name); c.restoreState()
+    c.showPage()
+
+def _read_week_text(page):
     try:
-        mm2pt = 72/25.4
-        rect = fitz.Rect(
-            CROP_RED['left']*mm2pt,
-            CROP_RED['top']*mm2pt,
-            doc[page_idx].rect.width - CROP_RED['right']*mm2pt,
-            doc[page_idx].rect.height - CROP_RED['bottom']*mm2pt
-        )
-        text = doc[page_idx].get_text('text', clip=rect)
+        text = page.get_text('text', clip=crop_rect(page, CROP_RED))
         for ln in (ln.strip() for ln in text.splitlines() if ln.strip()):
             if 'MER-' in ln or re.search(r'W\d{1,2}', ln):
                 return ln
@@ -167,92 +332,591 @@ def extract_week_text(doc, page_idx):
         pass
     return 'WEEK'
 
-def export_chunk_colorlabel(code, qty_val, base_img, dpi,
-                            start_n, end_n, total_display, out_suffix, out_dir):
-    global RED_FONT_NAME
-    try:
-        pdfmetrics.getFont(RED_FONT_NAME)
-    except:
-        try:
-            if os.path.exists(RED_FONT_FILE):
-                pdfmetrics.registerFont(TTFont(RED_FONT_NAME, RED_FONT_FILE))
-            else:
-                RED_FONT_NAME = 'Helvetica'
-        except:
-            RED_FONT_NAME = 'Helvetica'
-
-    ensure_dir(out_dir)
-    buf_img = io.BytesIO()
-    base_img.save(buf_img, format='JPEG', quality=85, optimize=True)
-    buf_img.seek(0)
-    img_reader = ImageReader(buf_img)
+def extract_week_text(doc, page_idx):
+    return page_index_for(doc).week_text(page_idx)
 
-    page_w, page_h = landscape(A4)
+def label_positions(page_w, page_h):
     label_w_pt = LABEL_W_MM * mm
     label_h_pt = LABEL_H_MM * mm
-    positions = [
+    return [
         (MARGIN_MM*mm, page_h - MARGIN_MM*mm - label_h_pt),
         (page_w - MARGIN_MM*mm - label_w_pt, page_h - MARGIN_MM*mm - label_h_pt),
         (MARGIN_MM*mm, MARGIN_MM*mm),
         (page_w - MARGIN_MM*mm - label_w_pt, MARGIN_MM*mm),
     ]
 
+def label_text_points(x, y):
+    label_w_pt = LABEL_W_MM * mm
+    label_h_pt = LABEL_H_MM * mm
     bx_norm, by_norm = BOX_REF[0]/REF_W, BOX_REF[1]/REF_H
     qx_norm, qy_norm = QTY_REF[0]/REF_W, QTY_REF[1]/REF_H
+    return ((x + bx_norm*label_w_pt - RED_SHIFT_MM*mm, y + (1 - by_norm)*label_h_pt),
+            (x + qx_norm*label_w_pt - RED_SHIFT_MM*mm, y + (1 - qy_norm)*label_h_pt))
+
+def colorlabel_filename(code, start_n, end_n, out_suffix):
+    ranged = f"{fmt_min2(start_n)}-{fmt_min2(end_n)}"
+    return f"{re.sub(r'[^A-Z0-9]', '', str(code).upper())}_ColorLabel_{ranged}_{out_suffix}.pdf"
+
+def export_chunk_colorlabel(code, qty_val, base_img, dpi,
+                            start_n, end_n, total_display, out_suffix, out_dir, encoding=DEFAULT_PROFILE):
+    font_name = try_register_font(RED_FONT_FILE, RED_FONT_NAME, fallback='Helvetica')
+
+    ensure_dir(out_dir)
+    jpeg = bytes(base_img) if isinstance(base_img, (bytes, bytearray)) else encode_label_jpeg(base_img, encoding)
+    img_reader = ImageReader(io.BytesIO(jpeg))
 
     ranged = f"{fmt_min2(start_n)}-{fmt_min2(end_n)}"
-    out_name = f"{re.sub(r'[^A-Z0-9]', '', str(code).upper())}_ColorLabel_{ranged}_{out_suffix}.pdf"
-    out_path = os.path.join(out_dir, out_name)
-    c = canvas.Canvas(out_path, pagesize=landscape(A4))
+    out_path = os.path.join(out_dir, colorlabel_filename(code, start_n, end_n, out_suffix))
+    with run_stage('draw'):
+        c = pdf_canvas(out_path, encoding)
+        define_label_form(c, img_reader)
+        printed = draw_colorlabel_pages(c, LABEL_FORM, font_name, qty_val, start_n, end_n, total_display)
+    with run_stage('save'):
+        c.save()
+    count_output(out_path, printed)
+    print(f"[OK] ColorLabel -> {os.path.basename(out_path)} ({printed} nhãn; {ranged}/{total_display})")
+    return out_path
 
-    rows = columnize_rows(start_n, end_n)
+def draw_colorlabel_pages(c, form_name, font_name, qty_val, start_n, end_n, total_display):
+    slots = label_slots()
+    qty_text = f"{int(qty_val):02d}"
     printed = 0
-    for row in rows:
+    for row in columnize_rows(start_n, end_n):
+        c.setFillColorRGB(0, 0, 0); c.setFont(font_name, RED_TEXT_SIZE_PT)
         for pos_idx, cur in enumerate(row):
             if cur is None: continue
-            x, y = positions[pos_idx]
-            c.drawImage(img_reader, x, y, width=label_w_pt, height=label_h_pt)
-            c.setStrokeColorRGB(1, 0, 0); c.setLineWidth(1); c.rect(x, y, label_w_pt, label_h_pt, stroke=1, fill=0)
-            c.setFillColorRGB(0, 0, 0); c.setFont(RED_FONT_NAME, RED_TEXT_SIZE_PT)
-            bx_pt = x + bx_norm*label_w_pt - RED_SHIFT_MM*mm
-            by_pt = y + (1 - by_norm)*label_h_pt
-            qx_pt = x + qx_norm*label_w_pt - RED_SHIFT_MM*mm
-            qy_pt = y + (1 - qy_norm)*label_h_pt
+            x, y, (bx_pt, by_pt), (qx_pt, qy_pt) = slots[pos_idx]
+            c.saveState(); c.translate(x, y); c.doForm(form_name); c.restoreState()
             c.drawCentredString(bx_pt, by_pt, f"{fmt_min2(cur)}/{total_display}")
-            c.drawCentredString(qx_pt, qy_pt, f"{int(qty_val):02d}")
+            c.drawCentredString(qx_pt, qy_pt, qty_text)
             printed += 1
         c.showPage()
-    c.save()
+    return printed
+
+LABEL_FORM = 'ColorLabelStatic'
+_LABEL_SLOTS = []
+
+def label_slots():
+    # (x, y, counter point, qty point) for the 4 labels of a landscape A4 page
+    if not _LABEL_SLOTS:
+        for x, y in label_positions(*landscape(A4)):
+            _LABEL_SLOTS.append((x, y) + label_text_points(x, y))
+    return _LABEL_SLOTS
+
+def define_label_form(c, img_reader, name=LABEL_FORM):
+    # Image + red border drawn once per document; each label is then a Do of this form.
+    label_w_pt = LABEL_W_MM * mm
+    label_h_pt = LABEL_H_MM * mm
+    c.beginForm(name, lowerx=-1, lowery=-1, upperx=label_w_pt + 1, uppery=label_h_pt + 1)
+    c.drawImage(img_reader, 0, 0, width=label_w_pt, height=label_h_pt)
+    c.setStrokeColorRGB(1, 0, 0); c.setLineWidth(1); c.rect(0, 0, label_w_pt, label_h_pt, stroke=1, fill=0)
+    c.endForm()
+
+OUTPUT_BACKENDS = ('reportlab', 'fitz')
+
+def colorlabel_backend(backend, render='raster'):
+    # vector labels are grafted PDF pages, which only the fitz writer can place
+    if render == 'vector': return 'fitz'
+    return backend if backend in OUTPUT_BACKENDS else 'reportlab'
+
+_FITZ_FONTS = {}
+
+def fitz_font(ttf_path=RED_FONT_FILE, name=RED_FONT_NAME):
+    # (fontname, fontfile, fitz.Font) for insert_text and text_length
+    key = (ttf_path, name)
+    if key not in _FITZ_FONTS:
+        try:
+            if os.path.exists(ttf_path):
+                _FITZ_FONTS[key] = (name, ttf_path, fitz.Font(fontfile=ttf_path))
+        except Exception:
+            pass
+        _FITZ_FONTS.setdefault(key, ('helv', None, fitz.Font('helv')))
+    return _FITZ_FONTS[key]
+
+def fitz_red_font():
+    return fitz_font(RED_FONT_FILE, RED_FONT_NAME)
+
+def fitz_label_template(label_src):
+    # fitz counterpart of define_label_form: a one-page doc holding the finished label (artwork +
+    # red border) with a 1pt margin for the stroke. show_pdf_page grafts it once per output doc.
+    # label_src: JPEG bytes (raster) or (src_doc, page_idx) (vector)
+    label_w_pt = LABEL_W_MM * mm
+    label_h_pt = LABEL_H_MM * mm
+    tpl = fitz.open()
+    page = tpl.new_page(width=label_w_pt + 2, height=label_h_pt + 2)
+    rect = fitz.Rect(1, 1, 1 + label_w_pt, 1 + label_h_pt)
+    if isinstance(label_src, (bytes, bytearray)):
+        page.insert_image(rect, stream=bytes(label_src), keep_proportion=False)
+    else:
+        src_doc, page_idx = label_src
+        page.show_pdf_page(rect, src_doc, page_idx, clip=crop_rect(src_doc[page_idx], CROP_RED), keep_proportion=False)
+    page.draw_rect(rect, color=(1, 0, 0), width=1)
+    return tpl
+
+def fitz_form(out, tpl):
+    # tpl's page as one form XObject of `out` (its xref), drawn at the PDF origin at its own size.
+    # show_pdf_page adds a new wrapper form on every call; this grafts once on a scratch page and
+    # every placement after that is a `cm ... Do` of the same xref (see fitz_write_page).
+    scratch = out.new_page(width=tpl[0].rect.width, height=tpl[0].rect.height)
+    xref = scratch.show_pdf_page(scratch.rect, tpl, 0)
+    out.delete_page(scratch.number)
+    return xref
+
+def fitz_doc_font(out, ttf_path=RED_FONT_FILE, name=RED_FONT_NAME):
+    # The font inserted once into `out` for fitz_text. A TTF is an Identity-H font (text as glyph ids);
+    # the Helvetica fallback is a simple WinAnsi font. glyphs: char -> (string code, advance at size 1).
+    font_name, font_file, font = fitz_font(ttf_path, name)
+    scratch = out.new_page()
+    xref = scratch.insert_font(fontname=font_name, fontfile=font_file)
+    out.delete_page(scratch.number)
+    return dict(xref=xref, font=font, identity=font_file is not None, glyphs={})
+
+def _glyph(font, ch):
+    glyph = font['glyphs'].get(ch)
+    if glyph is None:
+        if font['identity']: code = f"{font['font'].has_glyph(ord(ch)):04x}"
+        else: code = '\\' + ch if ch in '\\()' else ch
+        glyph = font['glyphs'][ch] = (code, font['font'].glyph_advance(ord(ch)))
+    return glyph
+
+def fitz_text(font, size, x, y, text, centred=False, name='F0'):
+    # PDF operators for one line of black text at (x, y), PDF (bottom-left) coordinates
+    glyphs = [_glyph(font, ch) for ch in text]
+    if centred: x -= sum(adv for _, adv in glyphs) * size / 2
+    codes = ''.join(code for code, _ in glyphs)
+    s = f'<{codes}>' if font['identity'] else f'({codes})'
+    return f'BT /{name} {size:g} Tf 1 0 0 1 {x:.3f} {y:.3f} Tm {s} Tj ET\n'
+
+def fitz_font_unicode(out, font):
+    # fitz_text writes glyph ids; the ToUnicode map insert_font made comes from the font's cmap, where
+    # glyphs shared by several code points extract as the last one ('-' reads as U+2010). Rewrite it
+    # from the characters actually written, so text search and copy match the reportlab output.
+    if not font['identity'] or not font['glyphs']: return
+    kind, ref = out.xref_get_key(font['xref'], 'ToUnicode')
+    if kind == 'xref':
+        xref = int(ref.split()[0])
+    else:
+        xref = out.get_new_xref(); out.update_object(xref, '<<>>')
+        out.xref_set_key(font['xref'], 'ToUnicode', f'{xref} 0 R')
+    chars = {}
+    for ch, (code, _) in font['glyphs'].items(): chars.setdefault(code, ch)
+    entries = [f'<{code}> <{ch.encode("utf-16-be").hex().upper()}>' for code, ch in sorted(chars.items())]
+    blocks = ''.join(f'{len(entries[i:i + 100])} beginbfchar\n' + '\n'.join(entries[i:i + 100]) + '\nendbfchar\n'
+                     for i in range(0, len(entries), 100))
+    out.update_stream(xref, ('/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n'
+                             '/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n'
+                             '/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n'
+                             '1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n' + blocks +
+                             'endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend\n').encode('ascii'))
+
+def fitz_resources(out, forms=None, fonts=None):
+    # one shared /Resources object ({name: xref}) for the pages written by fitz_write_page
+    res = ''
+    if forms: res += '/XObject<<' + ''.join(f'/{n} {x} 0 R' for n, x in forms.items()) + '>>'
+    if fonts: res += '/Font<<' + ''.join(f'/{n} {x} 0 R' for n, x in fonts.items()) + '>>'
+    xref = out.get_new_xref()
+    out.update_object(xref, f'<<{res}>>')
+    return xref
+
+def fitz_write_page(out, ops, resources, width, height):
+    # Appends a page straight through MuPDF: shared resources plus one content stream of raw operators.
+    # new_page and per-page resource edits cost more than the labels themselves.
+    pdf = fitz.mupdf.pdf_specifics(out.this)
+    page = fitz.mupdf.pdf_add_page(pdf, fitz.mupdf.FzRect(0, 0, width, height), 0,
+                                   fitz.mupdf.pdf_new_indirect(pdf, resources, 0),
+                                   fitz.mupdf.fz_new_buffer_from_copied_data(ops.encode('latin-1', 'replace')))
+    fitz.mupdf.pdf_insert_page(pdf, -1, page)
+
+def export_chunk_colorlabel_fitz(code, qty_val, label_src, start_n, end_n, total_display, out_suffix, out_dir,
+                                 encoding=DEFAULT_PROFILE):
+    ensure_dir(out_dir)
+    ranged = f"{fmt_min2(start_n)}-{fmt_min2(end_n)}"
+    out_path = os.path.join(out_dir, colorlabel_filename(code, start_n, end_n, out_suffix))
+    with run_stage('draw'):
+        out = fitz.open(); tpl = fitz_label_template(label_src); font = fitz_doc_font(out)
+        printed = draw_colorlabel_pages_fitz(out, fitz_form(out, tpl), font, qty_val, start_n, end_n, total_display)
+    with run_stage('save'):
+        save_fitz(out, out_path, encoding, fonts=[font])
+        out.close(); tpl.close()
+    count_output(out_path, printed)
     print(f"[OK] ColorLabel -> {os.path.basename(out_path)} ({printed} nhãn; {ranged}/{total_display})")
+    return out_path
 
-def to_int_safe(x):
-    try:
-        s = str(x).strip()
-        if s == '' or s.lower() in ('nan','none','null'):
-            return 0
-        return int(float(s))
-    except:
-        return 0
+def draw_colorlabel_pages_fitz(out, form, font, qty_val, start_n, end_n, total_display):
+    # form: fitz_form() xref of the label template, font: fitz_doc_font(); both shared by every page of `out`
+    page_w, page_h = landscape(A4)
+    qty_text = f"{int(qty_val):02d}"
+    resources = fitz_resources(out, forms={'Lbl': form}, fonts={'F0': font['xref']})
+    printed = 0
+    for row in columnize_rows(start_n, end_n):
+        ops = []
+        for pos_idx, cur in enumerate(row):
+            if cur is None: continue
+            x, y, (bx_pt, by_pt), (qx_pt, qy_pt) = label_slots()[pos_idx]
+            # the template has a 1pt margin for the border stroke
+            ops.append(f'q 1 0 0 1 {x - 1:.3f} {y - 1:.3f} cm /Lbl Do Q\n')
+            ops.append(fitz_text(font, RED_TEXT_SIZE_PT, bx_pt, by_pt, f"{fmt_min2(cur)}/{total_display}", centred=True))
+            ops.append(fitz_text(font, RED_TEXT_SIZE_PT, qx_pt, qy_pt, qty_text, centred=True))
+            printed += 1
+        fitz_write_page(out, ''.join(ops), resources, page_w, page_h)
+    return printed
 
-def find_page_by_code(doc, code: str):
-    for i, page in enumerate(doc):
-        if code in page.get_text('text'):
-            return i
+# Code39 as wide(1)/narrow(0) elements, bar first; same symbol set and geometry as reportlab's
+# Standard39 (ratio 2.2, gap = narrow bar, quiet zone max(1/4", 10 bars)).
+CODE39_PATTERNS = {
+    '0': '000110100', '1': '100100001', '2': '001100001', '3': '101100000', '4': '000110001',
+    '5': '100110000', '6': '001110000', '7': '000100101', '8': '100100100', '9': '001100100',
+    'A': '100001001', 'B': '001001001', 'C': '101001000', 'D': '000011001', 'E': '100011000',
+    'F': '001011000', 'G': '000001101', 'H': '100001100', 'I': '001001100', 'J': '000011100',
+    'K': '100000011', 'L': '001000011', 'M': '101000010', 'N': '000010011', 'O': '100010010',
+    'P': '001010010', 'Q': '000000111', 'R': '100000110', 'S': '001000110', 'T': '000010110',
+    'U': '110000001', 'V': '011000001', 'W': '111000000', 'X': '010010001', 'Y': '110010000',
+    'Z': '011010000', '-': '010000101', '.': '110000100', ' ': '011000100', '*': '010010100',
+}
+CODE39_BAR_W = 0.25 * mm
+CODE39_RATIO = 2.2
+
+def code39_bars(value):
+    # [(x, width)] of the bars in points, plus the total width including both quiet zones
+    narrow, wide = CODE39_BAR_W, CODE39_BAR_W * CODE39_RATIO
+    quiet = max(18.0, 10 * narrow)
+    x = quiet; bars = []
+    for i, ch in enumerate('*' + re.sub(r'[^A-Z0-9]', '', str(value).upper()) + '*'):
+        if i: x += narrow   # inter-character gap
+        for k, bit in enumerate(CODE39_PATTERNS[ch]):
+            w = wide if bit == '1' else narrow
+            if k % 2 == 0: bars.append((x, w))
+            x += w
+    return bars, x + quiet
+
+def fitz_hangtag_form(out, code_text, week_text, font):
+    # fitz counterpart of define_hangtag_form: the cell as one form XObject of `out` (its xref), same
+    # bbox and origin as the reportlab form. font: fitz_doc_font() of the bold face, shared per document.
+    cell_w, cell_h = HANGTAG_CELL_W, HANGTAG_CELL_H
+    pad = max(0, (BARSCALE_W_MM*mm - cell_w)/2) + 1
+    ops = [f'q 0 0.8 1 RG {BLUE_BORDER_PT:g} w 0 0 {cell_w:.3f} {cell_h:.3f} re S Q\n', '0 g\n',
+           fitz_text(font, CODE_FONTSIZE_PT, 3*mm, 4*mm, re.sub(r'[^A-Z0-9]', '', str(code_text).upper())),
+           fitz_text(font, WEEK_FONTSIZE_PT, 3*mm, 1*mm, str(week_text))]
+
+    # same placement as draw_code39_on_canvas: symbol incl. quiet zones stretched to BARSCALE_W_MM
+    desired_w, desired_h = BARSCALE_W_MM*mm, BARSCALE_H_MM*mm
+    bars, total_w = code39_bars(code_text)
+    scale_x = desired_w / total_w
+    bx = (cell_w - desired_w)/2.0
+    by = (cell_h - desired_h)/2.0 - 5*mm + 4*mm
+    ops += [f'{bx + x*scale_x:.3f} {by:.3f} {w*scale_x:.3f} {desired_h:.3f} re\n' for x, w in bars]
+    ops.append('f\n')
+
+    xref = out.get_new_xref()
+    out.update_object(xref, f'<</Type/XObject/Subtype/Form/BBox[{-pad:.3f} -1 {cell_w + pad:.3f} {cell_h + 1:.3f}]'
+                            f'/Resources<</Font<</F0 {font["xref"]} 0 R>>>>>>')
+    out.update_stream(xref, ''.join(ops).encode('latin-1', 'replace'))
+    return xref
+
+def draw_hangtag_page_fitz(out, form):
+    # one sheet of 36 `cm Do` placements of the fitz_hangtag_form xref
+    page_w, page_h = landscape(A4)
+    resources = fitz_resources(out, forms={'Tag': form})
+    ops = ''.join(f'q 1 0 0 1 {x:.3f} {y:.3f} cm /Tag Do Q\n' for x, y in hangtag_cells(page_w, page_h))
+    fitz_write_page(out, ops, resources, page_w, page_h)
+
+def merged_filename(code=None):
+    return f"{re.sub(r'[^A-Z0-9]', '', str(code).upper())}_Merged.pdf" if code else 'Merged_All.pdf'
+
+class MergedWriter:
+    # One print-ready PDF for many chunks. The label image/XObject and the hangtag cell are
+    # embedded once per code and shared by every page; each chunk gets an outline entry.
+    def __init__(self, out_path, render='raster', nested=False, backend='reportlab', encoding=DEFAULT_PROFILE):
+        # nested: job-level file, chunks are grouped under one outline entry per code
+        self.out_path = out_path
+        self.render = render
+        self.backend = backend
+        self.encoding = encoding
+        self.nested = nested
+        self.pages = 0; self.labels = 0
+        self.c = None; self.doc = None; self.toc = []
+        self.forms = set(); self.templates = {}; self.fonts = {}; self.pending_code = None; self.n_marks = 0
+
+    def _open(self):
+        if self.c is not None or self.doc is not None: return
+        ensure_dir(os.path.dirname(self.out_path) or '.')
+        if colorlabel_backend(self.backend, self.render) == 'fitz':
+            self.doc = fitz.open()
+        else:
+            self.c = pdf_canvas(self.out_path, self.encoding)
+            self.c.showOutline()
+            self.red_font = try_register_font(RED_FONT_FILE, RED_FONT_NAME, fallback='Helvetica')
+            self.bold_font = try_register_font('Sansation_Bold.ttf', 'SansationBold')
+
+    def _fitz_font(self, ttf_path=RED_FONT_FILE, name=RED_FONT_NAME):
+        # each face is inserted into the merged doc once and shared by every page
+        if ttf_path not in self.fonts: self.fonts[ttf_path] = fitz_doc_font(self.doc, ttf_path, name)
+        return self.fonts[ttf_path]
+
+    def begin_code(self, code):
+        # the code's outline entry is written with its first page
+        if self.nested: self.pending_code = code
+
+    def _outline(self, title):
+        if self.pending_code is not None:
+            self._mark(self.pending_code, 0); self.pending_code = None
+        self._mark(title, 1 if self.nested else 0)
+
+    def _mark(self, title, level):
+        self.toc.append((level, title, self.pages + 1))
+        if self.c is not None:
+            key = f'm{self.n_marks}'; self.n_marks += 1
+            self.c.bookmarkPage(key); self.c.addOutlineEntry(title, key, level=level)
+
+    def add_colorlabel(self, code, job, label_src):
+        # label_src: cached JPEG bytes (raster) or (src_doc, page_idx) (vector)
+        self._open()
+        ranged = f"{fmt_min2(job['start'])}-{fmt_min2(job['end'])}"
+        self._outline(f"{code} {job['suffix']} {ranged}/{job['total']}")
+        with run_stage('draw'):
+            if self.doc is not None:
+                key = ('label', code)
+                if key not in self.templates:
+                    tpl = fitz_label_template(label_src)
+                    self.templates[key] = (tpl, fitz_form(self.doc, tpl))
+                printed = draw_colorlabel_pages_fitz(self.doc, self.templates[key][1], self._fitz_font(), job['qty'],
+                                                     job['start'], job['end'], job['total'])
+            else:
+                form = f'{LABEL_FORM}_{code}'
+                if form not in self.forms:
+                    define_label_form(self.c, ImageReader(io.BytesIO(label_src)), name=form); self.forms.add(form)
+                printed = draw_colorlabel_pages(self.c, form, self.red_font, job['qty'],
+                                                job['start'], job['end'], job['total'])
+        run_count('labels_drawn', printed)
+        self.pages += label_page_count(job['start'], job['end']); self.labels += printed
+        print(f"[OK] ColorLabel {ranged}/{job['total']} ({printed} nhãn) -> {os.path.basename(self.out_path)}")
+        return printed
+
+    def add_hangtag(self, code, week_text):
+        self._open()
+        self._outline(f'{code} Hangtag')
+        with run_stage('hangtag'):
+            if self.doc is not None and self.backend == 'fitz':
+                key = ('hangtag', code)
+                if key not in self.templates:
+                    font = self._fitz_font('Sansation_Bold.ttf', 'SansationBold')
+                    self.templates[key] = (None, fitz_hangtag_form(self.doc, code, week_text, font))
+                draw_hangtag_page_fitz(self.doc, self.templates[key][1])
+            elif self.doc is not None:
+                buf = io.BytesIO()
+                c = canvas.Canvas(buf, pagesize=landscape(A4))
+                define_hangtag_form(c, code, week_text, try_register_font('Sansation_Bold.ttf', 'SansationBold'))
+                draw_hangtag_page(c); c.save()
+                with fitz.open(stream=buf.getvalue(), filetype='pdf') as src:
+                    self.doc.insert_pdf(src)
+            else:
+                form = f'{HANGTAG_FORM}_{code}'
+                if form not in self.forms:
+                    define_hangtag_form(self.c, code, week_text, self.bold_font, name=form); self.forms.add(form)
+                draw_hangtag_page(self.c, form)
+        self.pages += 1
+        print(f"[OK] Hangtag {code} -> {os.path.basename(self.out_path)}")
+
+    def close(self):
+        if self.pages == 0: return None
+        with run_stage('save'):
+            if self.doc is not None:
+                self.doc.set_toc([[level + 1, title, page] for level, title, page in self.toc])
+                save_fitz(self.doc, self.out_path, self.encoding, fonts=self.fonts.values()); self.doc.close()
+                for tpl, _ in self.templates.values():
+                    if tpl is not None: tpl.close()
+            else:
+                self.c.save()
+        count_output(self.out_path)
+        print(f"[OK] Merged -> {os.path.basename(self.out_path)} ({self.pages} trang; {self.labels} nhãn)")
+        return self.out_path
+
+def _alt_code(code: str) -> str:
     if code.startswith('C') and not code.startswith('CC'):
-        alt = 'CC' + code[1:]
+        return 'CC' + code[1:]
     elif code.startswith('CC'):
-        alt = 'C' + code[2:]
-    else:
-        alt = 'CC' + code
-    for i, page in enumerate(doc):
-        if alt in page.get_text('text'):
-            return i
-    pattern = r''.join([re.escape(ch) + r'[\s\-]*' for ch in code])
-    rx = re.compile(pattern)
-    for i, page in enumerate(doc):
-        if rx.search(page.get_text('text')):
-            return i
-    return None
+        return 'C' + code[2:]
+    return 'CC' + code
+
+def _squash_code(s: str) -> str:
+    return re.sub(r'[\s\-]+', '', s)
+
+def _letter_suffixes(tok: str):
+    # 'XCC12' also contains 'CC12' and 'C12'
+    n_letters = len(tok) - len(tok.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    return (tok[k:] for k in range(max(n_letters, 1)))
+
+class PageIndex:
+    # Doc text is read once; codes map to the first page that shows them.
+    TOKEN_RX = re.compile(r'[A-Z]+\d+')
+    FUZZY_RX = re.compile(r'[A-Z](?:[\s\-]*[A-Z])*(?:[\s\-]*\d)+')
+
+    def __init__(self, doc, texts=None, weeks=None, sources=None):
+        # texts/weeks: per-page text and week line from the on-disk index (see open_pdf); skips extraction.
+        # sources: [(path, first_page, n_pages)] when doc is several files concatenated
+        self.doc = doc
+        self.sources = sources or []
+        self.exact = {}; self.fuzzy = {}; self.weeks = dict(weeks or {}); self.jpegs = {}; self.digests = {}; self.xref_digests = {}
+        with run_stage('index'):
+            if texts is None:
+                texts = [page.get_text('text') for page in doc]
+                run_count('pages_scanned', len(texts))
+            else:
+                run_count('pages_cached', len(texts))
+            self.texts = texts
+            for i, text in enumerate(self.texts):
+                for tok in self.TOKEN_RX.findall(text):
+                    for key in _letter_suffixes(tok): self.exact.setdefault(key, i)
+                for m in self.FUZZY_RX.finditer(text):
+                    for key in _letter_suffixes(_squash_code(m.group(0))): self.fuzzy.setdefault(key, i)
+
+    def _scan(self, pred):
+        for i, text in enumerate(self.texts):
+            if pred(text): return i
+        return None
+
+    def find(self, code: str):
+        with run_stage('find'):
+            return self._find(code)
+
+    def _find(self, code):
+        alt = _alt_code(code)
+        for table, key in ((self.exact, code), (self.exact, alt), (self.fuzzy, _squash_code(code))):
+            if key in table: return table[key]
+        # Codes glued to other digits are not tokens; fall back to the cached texts.
+        i = self._scan(lambda t: code in t)
+        if i is None: i = self._scan(lambda t: alt in t)
+        if i is None:
+            rx = re.compile(r''.join([re.escape(ch) + r'[\s\-]*' for ch in code]))
+            i = self._scan(lambda t: rx.search(t) is not None)
+        return i
+
+    def source(self, page_idx):
+        # (file, 0-based page in that file) of a global page index
+        for path, first, n in self.sources:
+            if first <= page_idx < first + n: return path, page_idx - first
+        return (self.doc.name or None), page_idx
+
+    def week_text(self, page_idx):
+        if page_idx not in self.weeks:
+            self.weeks[page_idx] = _read_week_text(self.doc[page_idx])
+        return self.weeks[page_idx]
+
+    REF_RX = re.compile(r'(/Parent|/P\b)?\s*(\d+) 0 R')
+
+    def page_digest(self, page_idx):
+        # content stream + text + everything reachable from the page's /Resources (form XObjects and
+        # their own resources, images, fonts), so artwork that lives inside a form is covered too
+        if page_idx not in self.digests:
+            page = self.doc[page_idx]
+            h = hashlib.sha1(page.read_contents())
+            h.update(self.texts[page_idx].encode('utf-8'))
+            xref = page.xref
+            kind, res = self.doc.xref_get_key(xref, 'Resources')
+            while kind == 'null':   # inherited from the page tree
+                kind, parent = self.doc.xref_get_key(xref, 'Parent')
+                if kind != 'xref': break
+                xref = int(parent.split()[0])
+                kind, res = self.doc.xref_get_key(xref, 'Resources')
+            h.update(self._object_digest(res, set()).encode())
+            self.digests[page_idx] = h.hexdigest()
+        return self.digests[page_idx]
+
+    def _object_digest(self, text, stack):
+        # an object's text with each indirect reference replaced by the digest of its target,
+        # so the result does not depend on xref numbering; back-links (/Parent, /P) are not followed
+        def ref(m):
+            if m.group(1): return m.group(1) + ' R'
+            return ' ' + self._xref_digest(int(m.group(2)), stack)
+        return hashlib.sha1(self.REF_RX.sub(ref, text).encode('utf-8', 'replace')).hexdigest()
+
+    def _xref_digest(self, xref, stack):
+        if xref in self.xref_digests: return self.xref_digests[xref]
+        if xref in stack: return 'cycle'
+        stack.add(xref)
+        h = hashlib.sha1(self._object_digest(self.doc.xref_object(xref, compressed=True), stack).encode())
+        if self.doc.xref_is_stream(xref): h.update(self.doc.xref_stream_raw(xref) or b'')
+        stack.discard(xref)
+        self.xref_digests[xref] = h.hexdigest()
+        return self.xref_digests[xref]
+
+    def label_jpeg(self, code, page_idx, dpi, crop_conf=CROP_RED, encoding=DEFAULT_PROFILE):
+        key = (code, int(dpi), tuple(sorted(crop_conf.items())), encoding)
+        if key not in self.jpegs:
+            img = render_label_region(self.doc[page_idx], dpi=dpi, crop_conf=crop_conf)
+            self.jpegs[key] = encode_label_jpeg(img, encoding)
+        return self.jpegs[key]
+
+_PAGE_INDEXES = {}
+
+def page_index_for(doc):
+    idx = _PAGE_INDEXES.get(id(doc))
+    if idx is None or idx.doc is not doc:
+        idx = PageIndex(doc, sources=doc_sources(doc)); _PAGE_INDEXES[id(doc)] = idx
+    return idx
+
+_DOC_SOURCES = {}
+
+def doc_sources(doc):
+    # [(path, first_page, n_pages)] for documents built by open_pdf from several files
+    entry = _DOC_SOURCES.get(id(doc))
+    return entry[1] if entry and entry[0] is doc else None
+
+_DOC_LOCKS = {}
+_DOC_LOCKS_GUARD = threading.Lock()
+
+def doc_lock(doc):
+    # one RLock per open document: a fitz document and its PageIndex must not be used from two threads
+    # at once, so callers that share a document between threads (label_app / label_jobs) hold this
+    with _DOC_LOCKS_GUARD:
+        entry = _DOC_LOCKS.get(id(doc))
+        if entry is None or entry[0] is not doc:
+            entry = _DOC_LOCKS[id(doc)] = (doc, threading.RLock())
+        return entry[1]
+
+def find_page_by_code(doc, code: str):
+    return page_index_for(doc).find(code)
+
+PREVIEW_DPI = 50           # ColorLabel thumbnail: crop render + JPEG, a few ms per code
+PREVIEW_HANGTAG_DPI = 150  # the hangtag cell is vector and small; lower than this the barcode blurs
+
+def preview_label(doc, code, job=None, dpi=PREVIEW_DPI, marks=True):
+    # Thumbnails of one code before a full run: {'page', 'colorlabel', 'hangtag', 'week'} with PNG bytes,
+    # or None if the code is not in the PDF. The ColorLabel is the first slot of the first page exactly as
+    # draw_colorlabel_pages_fitz lays it out (job: a plan_group 'color' job for qty/start/total);
+    # marks adds crosshairs at BOX_REF/QTY_REF so a shifted crop shows against the artwork boxes.
+    index = page_index_for(doc)
+    page_idx = index.find(code)
+    if page_idx is None: return None
+    job = job or dict(qty=0, start=1, total=1)
+    week = index.week_text(page_idx)
+    label_w_pt = LABEL_W_MM * mm
+    label_h_pt = LABEL_H_MM * mm
+
+    out = fitz.open(); tpl = fitz_label_template(index.label_jpeg(code, page_idx, dpi))
+    draw_colorlabel_pages_fitz(out, fitz_form(out, tpl), fitz_doc_font(out), job['qty'], job['start'], job['start'], job['total'])
+    page = out[0]; page_h = page.rect.height
+    x, y = label_slots()[0][:2]
+    clip = fitz.Rect(x - 1, page_h - y - label_h_pt - 1, x + label_w_pt + 1, page_h - y + 1)
+    if marks:
+        arm = 2 * mm
+        for rx, ry in (BOX_REF, QTY_REF):
+            cx, cy = clip.x0 + 1 + rx/REF_W*label_w_pt, clip.y0 + 1 + ry/REF_H*label_h_pt
+            page.draw_line((cx - arm, cy), (cx + arm, cy), color=(0, 0.4, 1), width=0.5)
+            page.draw_line((cx, cy - arm), (cx, cy + arm), color=(0, 0.4, 1), width=0.5)
+    label_png = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72), clip=clip, alpha=False).tobytes('png')
+    out.close(); tpl.close()
+
+    # one hangtag cell on a page the size of the form's bbox
+    out = fitz.open()
+    form = fitz_hangtag_form(out, code, week, fitz_doc_font(out, 'Sansation_Bold.ttf', 'SansationBold'))
+    pad = max(0, (BARSCALE_W_MM*mm - HANGTAG_CELL_W)/2) + 1
+    fitz_write_page(out, f'q 1 0 0 1 {pad:.3f} 1 cm /Tag Do Q\n', fitz_resources(out, forms={'Tag': form}),
+                    HANGTAG_CELL_W + 2*pad, HANGTAG_CELL_H + 2)
+    hangtag_png = out[0].get_pixmap(matrix=fitz.Matrix(PREVIEW_HANGTAG_DPI/72, PREVIEW_HANGTAG_DPI/72),
+                                    alpha=False).tobytes('png')
+    out.close()
+    return dict(page=index.source(page_idx), week=week, colorlabel=label_png, hangtag=hangtag_png)
 
 def pick_first_existing(files, prefer_keywords=None):
     if not files: return None
@@ -264,18 +928,27 @@ def pick_first_existing(files, prefer_keywords=None):
     files_sorted = sorted(files, key=lambda p: os.path.getmtime(p), reverse=True)
     return files_sorted[0]
 
+def _is_pdf_source(arg):
+    return arg.lower().endswith('.pdf') or os.path.isdir(arg)
+
 def resolve_args(argv):
-    excel_file = None; pdf_file = None; dpi = DEFAULT_DPI; selected = 'all'
+    # <excel.xlsx> <a.pdf|folder> [more .pdf|folders ...] [dpi] [codes]; pdf_file is a list when several
+    excel_file = None; pdf_file = None; dpi = None; selected = 'all'   # dpi None: the encoding profile's
     args = argv[1:]
     positionals = [a for a in args if not a.startswith('--')]
-    if (len(positionals) >= 2 and positionals[0].lower().endswith('.xlsx') and positionals[1].lower().endswith('.pdf')):
-        excel_file, pdf_file = positionals[0], positionals[1]
-        if len(positionals) >= 3:
-            p3 = positionals[2].strip()
+    n_pdf = 0
+    while 1 + n_pdf < len(positionals) and _is_pdf_source(positionals[1 + n_pdf]): n_pdf += 1
+    if (len(positionals) >= 2 and positionals[0].lower().endswith('.xlsx') and n_pdf):
+        excel_file = positionals[0]
+        pdfs = positionals[1:1 + n_pdf]
+        pdf_file = pdfs[0] if len(pdfs) == 1 else pdfs
+        rest = positionals[1 + n_pdf:]
+        if rest:
+            p3 = rest[0].strip()
             try:
                 dpi = int(p3)
-                if len(positionals) >= 4:
-                    selected = positionals[3]
+                if len(rest) >= 2:
+                    selected = rest[1]
             except ValueError:
                 selected = p3
     else:
@@ -286,14 +959,19 @@ def resolve_args(argv):
             selected = positionals[1]
         excel_file = os.environ.get('EXCEL_FILE')
         pdf_file   = os.environ.get('PDF_FILE')
+        if pdf_file and os.pathsep in pdf_file:
+            pdf_file = [p for p in pdf_file.split(os.pathsep) if p]
         if not excel_file or not os.path.exists(excel_file):
             xlxs = glob.glob('*.xlsx'); excel_file = pick_first_existing(xlxs, prefer_keywords=['W','week'])
-        if not pdf_file or not os.path.exists(pdf_file):
+        if not pdf_file or (isinstance(pdf_file, str) and not os.path.exists(pdf_file)):
             pdfs = glob.glob('*.pdf'); pdf_file = pick_first_existing(pdfs, prefer_keywords=['label','labels'])
     if not excel_file or not os.path.exists(excel_file):
         print('Khong tim thay file Excel.'); sys.exit(1)
-    if not pdf_file or not os.path.exists(pdf_file):
+    if not pdf_file:
         print('Khong tim thay file PDF.'); sys.exit(1)
+    missing = [p for p in (pdf_file if isinstance(pdf_file, list) else [pdf_file]) if not os.path.exists(p)]
+    if missing or not pdf_sources(pdf_file):
+        print(f'Khong tim thay file PDF: {", ".join(missing) or pdf_file}'); sys.exit(1)
     return excel_file, pdf_file, dpi, selected, args
 
 def parse_manual_range(args):
@@ -313,102 +991,475 @@ def parse_manual_range(args):
             except: pass
     return mf, mt
 
-def process_group(doc, df_group, export_mode, dpi, manual_range=None, mode_tag='default'):
-    code = re.sub(r'[^A-Z0-9]', '', str(df_group.iloc[0]['code_norm']).upper())
-    out_dir = code_outdir(code)
-    page_idx = find_page_by_code(doc, code)
-    if page_idx is None:
-        print(f'BO QUA: Khong thay ma {code} trong PDF'); return
-    page_img = render_full_page(doc[page_idx], dpi=dpi)
-    base_img = crop_region(page_img, CROP_RED, dpi)
+def plan_group(df_group, export_mode, manual_range=None, mode_tag='default'):
+    # Range logic only; returns (code, jobs) without touching the PDF.
+    # df_group comes from load_orders, so every number is already an int column.
+    code = df_group['code_clean'].iat[0]
+    want_hangtag = export_mode in ('hangtag','both')
+    jobs = []
+
+    def color(qty_val, start_n, end_n, total_display, out_suffix):
+        jobs.append(dict(kind='color', qty=qty_val, start=int(start_n), end=int(end_n),
+                         total=int(total_display), suffix=out_suffix))
 
     if manual_range:
-        row0 = df_group.iloc[0]
-        qty_val  = to_int_safe(row0.get('qty_col_val', 0))
-        sl_tong_val = to_int_safe(row0.get('sltong_val', 0))
-        denom = (sl_tong_val // max(qty_val,1)) if (sl_tong_val > 0 and qty_val > 0) else 0
+        qty_val = int(df_group['qty_int'].iat[0])
+        denom = int(df_group['denom'].iat[0])
         pf, pt = manual_range
         if denom and pt > denom: pt = denom
         if pf < 1 or (denom and pf > denom) or pf > pt:
-            print(f'BO QUA: Khoang khong hop le cho {code}: {pf}-{pt} / {denom or "N/A"}')
-            return
-        lsx_tag = sanitize_for_filename(row0.get('lsx_val', ''))
-        export_chunk_colorlabel(code, qty_val, base_img, dpi,
-                                start_n=int(pf), end_n=int(pt), total_display=int(denom or pt),
-                                out_suffix=lsx_tag or 'LSX', out_dir=out_dir)
-        if export_mode in ('hangtag','both'):
-            wtxt = extract_week_text(doc, page_idx)
-            export_hangtag_generated(code, wtxt, out_dir=out_dir)
-        return
+            jobs.append(dict(kind='skip', msg=f'BO QUA: Khoang khong hop le cho {code}: {pf}-{pt} / {denom or "N/A"}'))
+            return code, jobs
+        color(qty_val, pf, pt, denom or pt, df_group['lsx_tag'].iat[0] or 'LSX')
+        if want_hangtag: jobs.append(dict(kind='hangtag'))
+        return code, jobs
 
+    rows = zip(df_group['qty_int'].tolist(), df_group['labels'].tolist(), df_group['denom'].tolist(),
+               df_group['has_range'].tolist(), df_group['from_int'].tolist(), df_group['to_int'].tolist(),
+               df_group['lsx_tag'].tolist())
     if mode_tag == 'from_excel':
         cum_start = 1
-        for _, row in df_group.iterrows():
-            so_luong = to_int_safe(row.get('sl_col_val', 0))
-            qty_val  = to_int_safe(row.get('qty_col_val', 0))
-            labels_this_row = (so_luong // qty_val) if qty_val > 0 else 0
-            if row.get('from_val') is not None and row.get('to_val') is not None:
-                pf = int(row['from_val']); pt = int(row['to_val'])
+        for qty_val, labels_this_row, denom, has_range, from_n, to_n, lsx_tag in rows:
+            if has_range:
+                pf = from_n; pt = to_n
             else:
                 pf = cum_start; pt = cum_start + max(labels_this_row, 0) - 1
-            sl_tong_val = to_int_safe(row.get('sltong_val', 0))
-            denom = (sl_tong_val // max(qty_val,1)) if (sl_tong_val > 0 and qty_val > 0) else max(pt, 0)
-            lsx_tag = sanitize_for_filename(row.get('lsx_val', ''))
             if (labels_this_row > 0 and pf <= pt):
-                export_chunk_colorlabel(code, qty_val, base_img, dpi,
-                                        start_n=int(pf), end_n=int(pt), total_display=int(denom),
-                                        out_suffix=lsx_tag, out_dir=out_dir)
-            if export_mode in ('hangtag','both'):
-                wtxt = extract_week_text(doc, page_idx)
-                export_hangtag_generated(code, wtxt, out_dir=out_dir)
+                color(qty_val, pf, pt, denom or max(pt, 0), lsx_tag)
+            # one hangtag per code: every row would rewrite the same (code, week) sheet
+            if want_hangtag and not any(j['kind'] == 'hangtag' for j in jobs):
+                jobs.append(dict(kind='hangtag'))
             cum_start = int(max(pt, cum_start-1)) + 1
     else:
-        for _, row in df_group.iterrows():
-            so_luong = to_int_safe(row.get('sl_col_val', 0))
-            qty_val  = to_int_safe(row.get('qty_col_val', 0))
-            num_labels = (so_luong // qty_val) if qty_val > 0 else 0
+        for qty_val, num_labels, denom, _, _, _, _ in rows:
             if num_labels <= 0: continue
-            sl_tong_val = to_int_safe(row.get('sltong_val', 0))
-            denom = (sl_tong_val // max(qty_val,1)) if (sl_tong_val > 0 and qty_val > 0) else num_labels
-            cur = 1
-            while cur <= num_labels:
-                end = min(cur + DEFAULT_SPLIT - 1, num_labels)
-                export_chunk_colorlabel(code, qty_val, base_img, dpi,
-                                        start_n=cur, end_n=end, total_display=int(denom),
-                                        out_suffix='LSX', out_dir=out_dir)
-                cur = end + 1
-        if export_mode in ('hangtag','both'):
-            wtxt = extract_week_text(doc, page_idx)
-            export_hangtag_generated(code, wtxt, out_dir=out_dir)
+            denom = denom or num_labels
+            for cur in range(1, num_labels + 1, DEFAULT_SPLIT):
+                color(qty_val, cur, min(cur + DEFAULT_SPLIT - 1, num_labels), denom, 'LSX')
+        if want_hangtag: jobs.append(dict(kind='hangtag'))
+    return code, jobs
 
-def main():
-    EXCEL_FILE, PDF_FILE, dpi, selected, argv_full = resolve_args(sys.argv)
-    export_mode = 'both'
-    for a in argv_full:
-        if a.startswith('--export='):
-            v = a.split('=',1)[1].strip().lower()
-            if v in ('color','hangtag','both'): export_mode = v
+def cap_jobs(jobs, max_pages):
+    # Split ColorLabel jobs so no file exceeds max_pages pages; each file is saved (and its pages
+    # freed) before the next one starts, so memory stays bounded however large one range is.
+    if not max_pages: return jobs
+    per = int(max_pages) * 4
+    capped = []
+    for job in jobs:
+        if job['kind'] != 'color' or job['end'] - job['start'] + 1 <= per:
+            capped.append(job); continue
+        for start in range(job['start'], job['end'] + 1, per):
+            capped.append(dict(job, start=start, end=min(start + per - 1, job['end'])))
+    return capped
 
-    manual_from, manual_to = parse_manual_range(argv_full)
-    manual_range = (manual_from, manual_to) if (manual_from and manual_to) else None
-    from_excel = ('--range-from-excel' in argv_full)
+MANIFEST_NAME = '.manifest.json'
+_FILE_DIGESTS = {}
 
-    print('='*54); print('  XUAT TEM NHAN (v2.12.5)'); print('='*54)
-    print(f'Excel: {EXCEL_FILE}'); print(f'PDF  : {PDF_FILE}'); print(f'DPI  : {dpi}')
-    print(f'Export: {export_mode}'); print(f'Selected: {selected}')
-    if manual_range: print(f'Manual range: {manual_range[0]}-{manual_range[1]}')
-    print('='*54)
-    ensure_dir(OUTPUT_DIR)
+def file_digest(path):
+    if path not in _FILE_DIGESTS:
+        h = hashlib.sha1()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''): h.update(block)
+        _FILE_DIGESTS[path] = h.hexdigest()
+    return _FILE_DIGESTS[path]
 
-    df = pd.read_excel(EXCEL_FILE, dtype={'QTY': str})
+def job_filename(code, job):
+    if job['kind'] == 'color':
+        return colorlabel_filename(code, job['start'], job['end'], job['suffix'])
+    return hangtag_filename(code)
 
-    def find_col(df, names):
-        for n in names:
-            if n in df.columns: return n
-            lowmap = {c.lower(): c for c in df.columns}
-            if n.lower() in lowmap: return lowmap[n.lower()]
-        return None
+def job_digest(index, page_idx, code, job, dpi, render, backend='reportlab', encoding=DEFAULT_PROFILE):
+    # Everything that ends up in the output file; a change in any of it forces a rebuild.
+    inputs = dict(code=code, job=job, page=index.page_digest(page_idx),
+                  layout=[CROP_RED, REF_W, REF_H, BOX_REF, QTY_REF, LABEL_W_MM, LABEL_H_MM, MARGIN_MM,
+                          RED_TEXT_SIZE_PT, RED_SHIFT_MM, BLUE_BORDER_PT, CODE_FONTSIZE_PT,
+                          WEEK_FONTSIZE_PT, BARSCALE_W_MM, BARSCALE_H_MM],
+                  fonts=[file_digest(RED_FONT_FILE), file_digest('Sansation_Bold.ttf')])
+    if backend != 'reportlab':
+        inputs.update(backend=backend)   # only when set, so reportlab manifests stay valid
+    if encoding != DEFAULT_PROFILE:
+        inputs.update(encoding=encode_profile(encoding))   # the settings, so editing a profile rebuilds
+    if job['kind'] == 'color':
+        inputs.update(dpi=int(dpi), render=render)
+    else:
+        inputs.update(week=index.week_text(page_idx))
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class RunManifest:
+    # output path (relative to root) -> digest of its inputs; saved after every file so a crashed run resumes
+    def __init__(self, root, entries=None, autosave=True):
+        self.root = root
+        self.path = os.path.join(root, MANIFEST_NAME)
+        self.autosave = autosave
+        self.updates = []
+        self.entries = entries
+        if self.entries is None:
+            self.entries = {}
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f).get('files', {})
+            except (OSError, ValueError):
+                pass
+
+    def fresh(self, rel, digest):
+        return self.entries.get(rel) == digest and os.path.exists(os.path.join(self.root, rel))
+
+    def record(self, rel, digest):
+        self.entries[rel] = digest
+        self.updates.append((rel, digest))
+        if self.autosave: self.save()
+
+    def forget(self, rel):
+        if self.entries.pop(rel, None) is not None and self.autosave: self.save()
+
+    def for_code(self, code):
+        prefix = code + '/'
+        return {k: v for k, v in self.entries.items() if k.startswith(prefix)}
+
+    def save(self):
+        ensure_dir(self.root)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.entries}, f, ensure_ascii=False, indent=0, sort_keys=True)
+        os.replace(tmp, self.path)
+
+def report_stale(manifest, plans, all_codes=False):
+    stale = []
+    planned = {code for code, _, _ in plans}
+    if all_codes:
+        # codes that dropped out of the Excel entirely
+        for rel in sorted(manifest.entries):
+            if rel.split('/', 1)[0] not in planned:
+                path = os.path.join(manifest.root, rel)
+                if os.path.exists(path): stale.append(path)
+                manifest.forget(rel)
+    for code, jobs, _ in plans:
+        expected = {job_filename(code, j) for j in jobs if j['kind'] != 'skip'}
+        folder = os.path.join(manifest.root, code)
+        for path in sorted(glob.glob(os.path.join(folder, '*.pdf'))):
+            name = os.path.basename(path)
+            if name not in expected:
+                stale.append(path); manifest.forget(f'{code}/{name}')
+    for path in stale:
+        print(f'[STALE] {path} (khong con trong Excel)')
+    return stale
+
+# Size model for --plan: no rendering, so these are ballpark figures from typical outputs.
+EST_JPEG_BYTES_PER_PX = 0.12   # label crop at JPEG q85
+EST_FONT_BYTES = 12000         # embedded TTF subset, once per file
+EST_PAGE_BYTES = 450           # 4 labels' numbers + form references
+EST_HANGTAG_BYTES = 30000      # one sheet of barcodes
+PLAN_FIELDS = ['code', 'source', 'page', 'kind', 'start', 'end', 'total', 'labels', 'pages', 'file', 'est_bytes', 'status', 'note']
+
+def _label_image_bytes(page, dpi, render):
+    if render == 'vector':
+        return len(page.read_contents())
+    r = crop_rect(page)
+    return int((r.width / 72 * dpi) * (r.height / 72 * dpi) * EST_JPEG_BYTES_PER_PX)
+
+def plan_outputs(doc, plans, dpi=DEFAULT_DPI, render='raster', merge=None, out_root=None):
+    # One row per output a run would produce; uses the text index only, nothing is rasterized or written.
+    out_root = out_root or OUTPUT_DIR
+    index = page_index_for(doc)
+    rows = []
+    for code, jobs, _ in plans:
+        page_idx = index.find(code)
+        out_dir = os.path.join(out_root, code)  # code_outdir() without creating the folder
+        image_bytes = None
+        for job in jobs:
+            row = dict.fromkeys(PLAN_FIELDS)
+            source, local = index.source(page_idx) if page_idx is not None else (None, None)
+            row.update(code=code, source=source and os.path.basename(source),
+                       page=None if page_idx is None else local + 1, kind=job['kind'],
+                       labels=0, pages=0, est_bytes=0, status='ok', note='')
+            if job['kind'] == 'skip':
+                row.update(status='skip', note=job['msg']); rows.append(row); continue
+            if merge == 'job':
+                row['file'] = os.path.join(out_root, merged_filename())
+            elif merge == 'code':
+                row['file'] = os.path.join(out_dir, merged_filename(code))
+            else:
+                row['file'] = os.path.join(out_dir, job_filename(code, job))
+            if job['kind'] == 'color':
+                labels = job['end'] - job['start'] + 1
+                row.update(start=job['start'], end=job['end'], total=job['total'],
+                           labels=labels, pages=label_page_count(job['start'], job['end']))
+            else:
+                row['pages'] = 1
+            if page_idx is None:
+                row.update(status='missing', note='Khong thay ma trong PDF'); rows.append(row); continue
+            if job['kind'] == 'color':
+                est = row['pages'] * EST_PAGE_BYTES
+                first = image_bytes is None
+                if first: image_bytes = _label_image_bytes(doc[page_idx], dpi, render)
+                # merged files embed the label image and font once per code
+                if first or not merge: est += image_bytes + EST_FONT_BYTES
+                row['est_bytes'] = est
+            else:
+                row['est_bytes'] = EST_HANGTAG_BYTES
+            if job['kind'] == 'color' and job['end'] > job['total']:
+                row.update(status='warn', note=f"Den {job['end']} > tong {job['total']}")
+            rows.append(row)
+    return rows
+
+def print_plan(rows):
+    for r in rows:
+        if r['status'] == 'skip':
+            print(f"[SKIP]    {r['note']}"); continue
+        rng = f"{fmt_min2(r['start'])}-{fmt_min2(r['end'])}/{r['total']}" if r['kind'] == 'color' else 'hangtag'
+        page = f"{r['source'] or ''}:{r['page']}" if r['page'] is not None else '-'
+        tag = {'ok': '[PLAN]', 'missing': '[MISSING]', 'warn': '[WARN]'}[r['status']]
+        print(f"{tag:<10}{r['code']:<12} {page:<18} {rng:<20} {r['pages']:>5} tr  ~{r['est_bytes']/1024:8.1f} KB  "
+              f"{os.path.basename(r['file'])}{'  ' + r['note'] if r['note'] else ''}")
+    files = {r['file'] for r in rows if r['status'] in ('ok', 'warn')}
+    print(f"Tong: {len(files)} file, {sum(r['pages'] for r in rows if r['status'] != 'missing')} trang, "
+          f"{sum(r['labels'] for r in rows if r['status'] != 'missing')} tem, "
+          f"~{sum(r['est_bytes'] for r in rows)/1048576:.1f} MB")
+    missing = sorted({r['code'] for r in rows if r['status'] == 'missing'})
+    if missing: print(f"Thieu trong PDF ({len(missing)}): {', '.join(missing)}")
+
+def write_plan(rows, path):
+    # .csv opens straight in Excel (BOM for the Vietnamese notes); anything else is JSON
+    ensure_dir(os.path.dirname(path) or '.')
+    if path.lower().endswith('.csv'):
+        df = pd.DataFrame(rows, columns=PLAN_FIELDS)
+        # hangtag/skip/missing rows leave some numbers empty; nullable Int64 keeps the others from becoming 2.0
+        for col in ('page', 'start', 'end', 'total', 'labels', 'pages', 'est_bytes'):
+            df[col] = pd.to_numeric(df[col]).astype('Int64')
+        df.to_csv(path, index=False, encoding='utf-8-sig')
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=1)
+    print(f'[OK] Plan -> {path}')
+    return path
+
+class JobCancelled(Exception):
+    pass
+
+def _emit(progress, event, **data):
+    if progress is not None: progress(event, **data)
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set(): raise JobCancelled()
+
+def run_group_jobs(doc, code, jobs, dpi, render='raster', report_missing=True, manifest=None,
+                   progress=None, cancel=None, out_root=None, merged=None, backend='reportlab',
+                   encoding=DEFAULT_PROFILE):
+    out_dir = code_outdir(code, out_root)
+    index = page_index_for(doc)
+    page_idx = index.find(code)
+    if page_idx is None:
+        if report_missing: print(f'BO QUA: Khong thay ma {code} trong PDF')
+        return
+    if merged is not None: merged.begin_code(code)
+    for job in jobs:
+        _check_cancel(cancel)
+        if job['kind'] == 'skip':
+            print(job['msg']); continue
+        if merged is not None:
+            if job['kind'] == 'color':
+                src = (doc, page_idx) if render == 'vector' else index.label_jpeg(code, page_idx, dpi, encoding=encoding)
+                _emit(progress, 'labels', code=code, labels=merged.add_colorlabel(code, job, src))
+            elif job['kind'] == 'hangtag':
+                merged.add_hangtag(code, index.week_text(page_idx))
+            continue
+        if manifest is not None:
+            rel = f'{code}/{job_filename(code, job)}'
+            digest = job_digest(index, page_idx, code, job, dpi, render, backend, encoding)
+            if manifest.fresh(rel, digest):
+                print(f'[SKIP] {job_filename(code, job)} (khong doi)'); continue
+        labels = 0
+        if job['kind'] == 'color':
+            labels = job['end'] - job['start'] + 1
+            if colorlabel_backend(backend, render) == 'fitz':
+                src = (doc, page_idx) if render == 'vector' else index.label_jpeg(code, page_idx, dpi, encoding=encoding)
+                out_path = export_chunk_colorlabel_fitz(code, job['qty'], src, job['start'], job['end'],
+                                                        job['total'], job['suffix'], out_dir, encoding=encoding)
+            else:
+                out_path = export_chunk_colorlabel(code, job['qty'], index.label_jpeg(code, page_idx, dpi, encoding=encoding),
+                                                   dpi, job['start'], job['end'], job['total'], job['suffix'], out_dir,
+                                                   encoding=encoding)
+        elif job['kind'] == 'hangtag':
+            out_path = export_hangtag_generated(code, index.week_text(page_idx), out_dir=out_dir, backend=backend,
+                                                encoding=encoding)
+        if manifest is not None: manifest.record(rel, digest)
+        _emit(progress, 'file', code=code, kind=job['kind'], path=out_path, labels=labels)
+
+def run_code_merged(doc, code, jobs, dpi, render='raster', report_missing=True, progress=None, cancel=None, out_root=None,
+                    backend='reportlab', encoding=DEFAULT_PROFILE):
+    merged = MergedWriter(os.path.join(code_outdir(code, out_root), merged_filename(code)), render=render, backend=backend,
+                          encoding=encoding)
+    run_group_jobs(doc, code, jobs, dpi, render=render, report_missing=report_missing,
+                   progress=progress, cancel=cancel, out_root=out_root, merged=merged, backend=backend, encoding=encoding)
+    out_path = merged.close()
+    if out_path: _emit(progress, 'file', code=code, kind='merged', path=out_path, labels=0)
+
+def process_group(doc, df_group, export_mode, dpi, manual_range=None, mode_tag='default', render='raster',
+                  backend='reportlab', encoding=DEFAULT_PROFILE):
+    code, jobs = plan_group(df_group, export_mode, manual_range=manual_range, mode_tag=mode_tag)
+    run_group_jobs(doc, code, jobs, dpi, render=render, backend=backend, encoding=encoding)
+
+_WORKER_DOC = None
+
+def _init_worker(pdf_file, index_cache=None):
+    global _WORKER_DOC
+    _force_utf8()
+    _WORKER_DOC = open_pdf(pdf_file, index_cache=index_cache)
 
+def _run_task(code, jobs, dpi, render, header, first, manifest_entries=None, out_root=None, merge=None,
+              backend='reportlab', encoding=DEFAULT_PROFILE):
+    buf = io.StringIO()
+    manifest = RunManifest(out_root or OUTPUT_DIR, entries=manifest_entries, autosave=False) if manifest_entries is not None else None
+    events = []
+    err = None
+    stats = RunStats()
+    try:
+        with contextlib.redirect_stdout(buf):
+            if header and first: print(header)
+            collect = lambda event, **data: events.append((event, data))
+            with collect_stats(stats):
+                if merge == 'code':
+                    run_code_merged(_WORKER_DOC, code, jobs, dpi, render=render, progress=collect, out_root=out_root,
+                                    backend=backend, encoding=encoding)
+                else:
+                    run_group_jobs(_WORKER_DOC, code, jobs, dpi, render=render, report_missing=first, manifest=manifest,
+                                   progress=collect, out_root=out_root, backend=backend, encoding=encoding)
+    except Exception as e:
+        err = f'{type(e).__name__}: {e}'
+    # stage times and counters travel back with the other events
+    stats.peak('worker_peak_rss_mb', peak_rss_mb())
+    events.append(('stats', stats.as_dict()))
+    return buf.getvalue(), err, (manifest.updates if manifest else []), events
+
+def split_jobs(jobs, parts):
+    # Contiguous slices with roughly equal ColorLabel counts, so one huge code fans out too.
+    n_color = sum(1 for j in jobs if j['kind'] == 'color')
+    parts = max(1, min(parts, n_color))
+    if parts == 1: return [jobs]
+    per = -(-n_color // parts)
+    slices = [[]]; seen = 0
+    for job in jobs:
+        if job['kind'] == 'color':
+            if seen and seen % per == 0: slices.append([])
+            seen += 1
+        slices[-1].append(job)
+    return slices
+
+def run_parallel(pdf_file, plans, dpi, render, workers, manifest=None, progress=None, cancel=None, out_root=None,
+                 merge=None, backend='reportlab', index_cache=None, encoding=DEFAULT_PROFILE):
+    from concurrent.futures import ProcessPoolExecutor
+    tasks = []
+    for code, jobs, header in plans:
+        # a per-code merged file has a single writer, so its jobs stay in one task
+        parts = [jobs] if merge else split_jobs(jobs, workers)
+        for i, part in enumerate(parts):
+            tasks.append((code, part, header, i == 0, i == len(parts) - 1))
+    failed = []; codes_done = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(pdf_file, index_cache)) as ex:
+        futs = [ex.submit(_run_task, code, part, dpi, render, header, first,
+                          manifest.for_code(code) if manifest is not None else None, out_root, merge, backend, encoding)
+                for code, part, header, first, _ in tasks]
+        # results are printed in submission order: deterministic, and a code's lines stay together
+        for (code, _, _, _, last), fut in zip(tasks, futs):
+            if cancel is not None and cancel.is_set():
+                ex.shutdown(wait=True, cancel_futures=True)
+                raise JobCancelled()
+            try: log, err, updates, events = fut.result()
+            except Exception as e: log, err, updates, events = '', f'{type(e).__name__}: {e}', [], []
+            sys.stdout.write(log)
+            for rel, digest in updates: manifest.record(rel, digest)
+            for event, data in events:
+                if event == 'stats':
+                    if current_stats() is not None: current_stats().merge(data)
+                else:
+                    _emit(progress, event, **data)
+            if err:
+                print(f'LOI: {code}: {err}')
+                if code not in failed: failed.append(code)
+            if last:
+                codes_done += 1
+                _emit(progress, 'code', code=code, done=codes_done, total=len(plans))
+    return failed
+
+def find_col(df, names):
+    lowmap = {str(c).lower(): c for c in df.columns}
+    for n in names:
+        if n in df.columns: return n
+        if n.lower() in lowmap: return lowmap[n.lower()]
+    return None
+
+ORDER_CACHE_DIR = '.label_cache'
+ORDER_CACHE_VERSION = 1
+
+def _int_series(col):
+    # blanks/'nan'/text -> 0, floats truncated toward zero
+    num = pd.to_numeric(col.astype(str).str.strip(), errors='coerce')
+    return np.trunc(num.replace([np.inf, -np.inf], np.nan).fillna(0)).astype('int64')
+
+def _int_or_na(col):
+    num = pd.to_numeric(col.astype(str).str.strip(), errors='coerce').replace([np.inf, -np.inf], np.nan)
+    return np.trunc(num)
+
+def normalize_orders(df, code_col, qty_col, sl_col, sltong_col=None, lsx_col=None, from_col=None, to_col=None):
+    # One pass over whole columns: everything plan_group needs, already as ints.
+    df['code_norm'] = df[code_col].astype(str).str.replace(r'^CC', 'C', regex=True)
+    df['code_clean'] = df['code_norm'].str.upper().str.replace(r'[^A-Z0-9]', '', regex=True)
+    df['qty_col_val'] = df[qty_col]
+    df['sl_col_val']  = df[sl_col]
+    df['sltong_val']  = df[sltong_col] if sltong_col else 0
+    df['lsx_val']     = df[lsx_col] if lsx_col else ''
+
+    qty = _int_series(df['qty_col_val'])
+    sl = _int_series(df['sl_col_val'])
+    sltong = _int_series(df['sltong_val'])
+    ok_qty = qty > 0
+    df['qty_int'] = qty
+    df['labels'] = np.where(ok_qty, sl // qty.where(ok_qty, 1), 0).astype('int64')
+    # 0 = no SL Tổng; the fallback denominator depends on the range mode
+    df['denom'] = np.where(ok_qty & (sltong > 0), sltong // qty.where(ok_qty, 1), 0).astype('int64')
+
+    from_n = _int_or_na(df[from_col]) if from_col else pd.Series(np.nan, index=df.index)
+    to_n = _int_or_na(df[to_col]) if to_col else pd.Series(np.nan, index=df.index)
+    df['has_range'] = from_n.notna() & to_n.notna()
+    df['from_int'] = from_n.fillna(0).astype('int64')
+    df['to_int'] = to_n.fillna(0).astype('int64')
+    df['from_val'] = from_n.astype('Int64')
+    df['to_val'] = to_n.astype('Int64')
+    # sanitize each distinct LSX once; factorize puts blanks (NaN) at -1, i.e. the last tag
+    codes, uniques = pd.factorize(df['lsx_val'])
+    tags = np.array([sanitize_for_filename(v) for v in uniques] + [sanitize_for_filename(np.nan)], dtype=object)
+    df['lsx_tag'] = tags[codes]
+    return df
+
+def load_orders(excel, cache_dir=None):
+    # excel: path, raw .xlsx bytes or an already-read DataFrame.
+    # cache_dir: keep the normalized table as a pickle keyed by the workbook hash.
+    if isinstance(excel, pd.DataFrame):
+        return _normalize_loaded(excel.copy())
+    data = bytes(excel) if isinstance(excel, (bytes, bytearray)) else None
+    if data is None:
+        with open(excel, 'rb') as f: data = f.read()
+    cache_path = None
+    if cache_dir:
+        digest = hashlib.sha1(data).hexdigest()
+        cache_path = os.path.join(cache_dir, f'orders_v{ORDER_CACHE_VERSION}_{digest}.pkl')
+        if os.path.exists(cache_path):
+            try:
+                df = pd.read_pickle(cache_path)
+                run_count('order_cache_hits'); run_count('order_rows', len(df))
+                return df
+            except Exception: pass
+    with run_stage('excel'):
+        df = _normalize_loaded(pd.read_excel(io.BytesIO(data), dtype={'QTY': str}))
+    if df is not None: run_count('order_rows', len(df))
+    if df is not None and cache_path:
+        ensure_dir(cache_dir)
+        tmp = cache_path + '.tmp'
+        df.to_pickle(tmp); os.replace(tmp, cache_path)
+    return df
+
+def _normalize_loaded(df):
     code_col = find_col(df, ['Mã SP đối tác','Ma SP doi tac','Code','Mã SP','MÃ SP ĐỐI TÁC','MaSp','MASP'])
     qty_col  = find_col(df, ['QTY','Qty','qty'])
     sl_col   = find_col(df, ['Số lượng','So luong','SO LUONG','SoLuong','SOLUONG'])
@@ -418,42 +1469,482 @@ def main():
     to_col   = find_col(df, ['To','Đến','Den','End','Kết thúc','Ket thuc','Khoảng đến','Khoang den'])
 
     if not code_col or not qty_col or not sl_col:
-        print('Khong tim thay cac cot bat buoc (Code/QTY/Số lượng).'); return
+        print('Khong tim thay cac cot bat buoc (Code/QTY/Số lượng).'); return None
+    return normalize_orders(df, code_col, qty_col, sl_col, sltong_col, lsx_col, from_col, to_col)
 
-    df['code_norm'] = df[code_col].astype(str).str.replace(r'^CC', 'C', regex=True)
-    df['qty_col_val'] = df[qty_col]
-    df['sl_col_val']  = df[sl_col]
-    df['sltong_val']  = df[sltong_col] if sltong_col else 0
-    df['lsx_val']     = df[lsx_col] if lsx_col else ''
+PDF_INDEX_DIR = os.path.join(ORDER_CACHE_DIR, 'pdf_index')
+PDF_INDEX_VERSION = 1
+_PDF_STAMPS = {}
+
+def pdf_sources(pdf):
+    # a path, a directory of PDFs or a list of either -> PDF paths in a stable order
+    paths = []
+    for item in (pdf if isinstance(pdf, (list, tuple)) else [pdf]):
+        if os.path.isdir(item):
+            paths.extend(os.path.join(item, f) for f in sorted(os.listdir(item)) if f.lower().endswith('.pdf'))
+        else:
+            paths.append(item)
+    return paths
+
+def _write_json_atomic(path, data):
+    ensure_dir(os.path.dirname(path) or '.')
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def pdf_sha1(path, cache_dir):
+    # content hash of a source PDF; re-hashed only when its size or mtime changed
+    stamps_path = os.path.join(cache_dir, 'stamps.json')
+    stamps = _PDF_STAMPS.get(cache_dir)
+    if stamps is None:
+        try:
+            with open(stamps_path, encoding='utf-8') as f: stamps = json.load(f)
+        except (OSError, ValueError):
+            stamps = {}
+        _PDF_STAMPS[cache_dir] = stamps
+    st = os.stat(path); key = os.path.abspath(path)
+    hit = stamps.get(key)
+    if hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns:
+        return hit[2]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''): h.update(block)
+    stamps[key] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    _write_json_atomic(stamps_path, stamps)
+    return stamps[key][2]
+
+def cached_page_texts(doc, sha1, cache_dir):
+    # (texts, weeks) per page, from PDF_INDEX_DIR/pdf_<sha1>.json or extracted once and stored there
+    path = os.path.join(cache_dir, f'pdf_v{PDF_INDEX_VERSION}_{sha1}.json')
+    try:
+        with open(path, encoding='utf-8') as f: data = json.load(f)
+        if len(data['texts']) == len(doc): return data['texts'], data['weeks']
+    except (OSError, ValueError, KeyError):
+        pass
+    with run_stage('index'):
+        texts = [page.get_text('text') for page in doc]
+        weeks = [_read_week_text(page) for page in doc]
+    run_count('pages_scanned', len(texts))
+    _write_json_atomic(path, dict(version=PDF_INDEX_VERSION, sha1=sha1, pages=len(texts), texts=texts, weeks=weeks))
+    return texts, weeks
+
+def open_pdf(pdf, index_cache=None):
+    # pdf: path, directory, raw bytes, a list of those, or an open fitz.Document.
+    # Several files are concatenated into one document, so page numbers stay global everywhere else.
+    # index_cache: directory of the persistent text index (PDF_INDEX_DIR); indexed files skip text extraction.
+    if isinstance(pdf, fitz.Document): return pdf
+    parts = []   # (name, document, content sha1 or None)
+    for item in (pdf if isinstance(pdf, (list, tuple)) else [pdf]):
+        if isinstance(item, (bytes, bytearray)):
+            parts.append((f'<stream #{len(parts) + 1}>', fitz.open(stream=bytes(item), filetype='pdf'),
+                          hashlib.sha1(item).hexdigest() if index_cache else None))
+            continue
+        for path in pdf_sources(item):
+            parts.append((path, fitz.open(path), pdf_sha1(path, index_cache) if index_cache else None))
+    if not parts: raise FileNotFoundError(f'Khong co file PDF trong: {pdf}')
+    if len(parts) == 1:
+        doc = parts[0][1]
+    else:
+        doc = fitz.open()
+        for _, src, _ in parts: doc.insert_pdf(src)
+    sources = []; first = 0
+    for path, src, _ in parts:
+        sources.append((path, first, len(src))); first += len(src)
+    if len(sources) > 1: _DOC_SOURCES[id(doc)] = (doc, sources)
+    if index_cache:
+        texts = []; weeks = {}
+        for (path, src, sha1), (_, offset, _) in zip(parts, sources):
+            t, w = cached_page_texts(src, sha1, index_cache)
+            texts.extend(t); weeks.update((offset + i, wk) for i, wk in enumerate(w))
+        _PAGE_INDEXES[id(doc)] = PageIndex(doc, texts=texts, weeks=weeks, sources=doc_sources(doc))
+    for _, src, _ in parts:
+        if src is not doc: src.close()
+    return doc
+
+def close_pdf(doc):
+    # drop the per-document caches before closing, so a new document can't inherit them by id()
+    _PAGE_INDEXES.pop(id(doc), None); _DOC_SOURCES.pop(id(doc), None); _DOC_LOCKS.pop(id(doc), None)
+    doc.close()
+
+def warm_fonts():
+    return (try_register_font(RED_FONT_FILE, RED_FONT_NAME, fallback='Helvetica'),
+            try_register_font('Sansation_Bold.ttf', 'SansationBold'))
 
-    def _to_int_or_none(v):
-        try: return int(float(str(v)))
-        except: return None
-    df['from_val'] = df[from_col].apply(_to_int_or_none) if from_col else None
-    df['to_val']   = df[to_col].apply(_to_int_or_none) if to_col else None
+def _pool_source(pdf):
+    # what a worker process can open on its own
+    if isinstance(pdf, fitz.Document):
+        paths = [path for path, _, _ in doc_sources(pdf) or []]
+        if paths and all(os.path.exists(p) for p in paths): return paths
+        return pdf.name if pdf.name and os.path.exists(pdf.name) else pdf.tobytes()
+    return bytes(pdf) if isinstance(pdf, bytearray) else pdf
+
+def _source_label(src):
+    if isinstance(src, (bytes, bytearray)): return f'<{len(src)} bytes>'
+    if isinstance(src, pd.DataFrame): return f'<DataFrame {len(src)} dong>'
+    if isinstance(src, fitz.Document): return src.name or '<PDF stream>'
+    if isinstance(src, (list, tuple)) or os.path.isdir(src):
+        paths = pdf_sources(src)
+        return f'{len(paths)} file: ' + ', '.join(os.path.basename(p) for p in paths)
+    return src
+
+REPORT_NAME = 'run_report.json'
+CPROFILE_NAME = 'run_profile.prof'
+
+def generate(excel, pdf, mode='default', export='both', codes='all', range=None,
+             dpi=None, render='raster', workers=1, incremental=False,
+             progress=None, cancel=None, out_root=None, merge=None, order_cache=None, dry_run=False,
+             max_pages=None, backend='reportlab', index_cache=None, profile=None, cprofile=None,
+             encoding=DEFAULT_PROFILE):
+    # Runs _generate() with stage timers/counters installed; the result carries them as 'report'.
+    # profile / cprofile: True or a path -> write the JSON run report / a cProfile dump of this process
+    # (defaults: REPORT_NAME / CPROFILE_NAME in out_root). Worker processes only feed the report.
+    root = out_root or OUTPUT_DIR
+    encoding = encoding if encoding in ENCODE_PROFILES else DEFAULT_PROFILE
+    dpi = int(dpi or encode_profile(encoding)['dpi'])
+    stats = RunStats()
+    phases = {}
+    def track(event, **data):
+        if event == 'stage': phases[data['name']] = round(data['seconds'], 4)
+        _emit(progress, event, **data)
+    prof = None
+    if cprofile:
+        import cProfile
+        prof = cProfile.Profile()
+    started = time.time(); t0 = time.perf_counter()
+    try:
+        with collect_stats(stats):
+            if prof is not None: prof.enable()
+            try:
+                result = _generate(excel, pdf, mode=mode, export=export, codes=codes, range=range, dpi=dpi,
+                                   render=render, workers=workers, incremental=incremental, progress=track,
+                                   cancel=cancel, out_root=out_root, merge=merge, order_cache=order_cache,
+                                   dry_run=dry_run, max_pages=max_pages, backend=backend, index_cache=index_cache,
+                                   encoding=encoding)
+            finally:
+                if prof is not None: prof.disable()
+    finally:
+        if prof is not None:
+            prof_path = cprofile if isinstance(cprofile, str) else os.path.join(root, CPROFILE_NAME)
+            ensure_dir(os.path.dirname(prof_path) or '.')
+            prof.dump_stats(prof_path)
+            print(f'[OK] cProfile -> {prof_path}')
+    stats.peak('peak_rss_mb', peak_rss_mb())
+    report = dict(version=VERSION, started=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+                  wall_seconds=round(time.perf_counter() - t0, 4),
+                  options=dict(mode=mode, export=export,
+                               codes=','.join(codes) if isinstance(codes, (list, tuple)) else (codes or 'all'),
+                               range=list(range) if range else None, dpi=dpi, render=render, workers=workers,
+                               incremental=incremental, merge=merge, dry_run=dry_run, max_pages=max_pages,
+                               backend=backend, encoding=encoding),
+                  phases=phases, **stats.as_dict(),
+                  python=sys.version.split()[0], platform=sys.platform,
+                  codes=len(result['codes']) if result else 0, failed=list(result['failed']) if result else [])
+    if profile:
+        print_report(report)
+        write_report(report, profile if isinstance(profile, str) else os.path.join(root, REPORT_NAME))
+    if result is not None: result['report'] = report
+    return result
+
+def print_report(report):
+    opts = report['options']
+    print(f"-- Profile: {report['wall_seconds']:.2f}s ({opts.get('encoding', DEFAULT_PROFILE)}, {opts['dpi']} dpi)")
+    for name, st in sorted(report['stages'].items(), key=lambda kv: -kv[1]['seconds']):
+        print(f"  {name:<10} {st['seconds']:9.3f}s  x{st['calls']}")
+    for name, n in report['counters'].items():
+        print(f"  {name:<16} {n}")
+    for name, v in report['peaks'].items():
+        print(f"  {name:<16} {v} MB")
+
+def write_report(report, path):
+    ensure_dir(os.path.dirname(path) or '.')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f'[OK] Report -> {path}')
+    return path
+
+def _generate(excel, pdf, mode='default', export='both', codes='all', range=None,
+              dpi=None, render='raster', workers=1, incremental=False,
+              progress=None, cancel=None, out_root=None, merge=None, order_cache=None, dry_run=False,
+              max_pages=None, backend='reportlab', index_cache=None, encoding=DEFAULT_PROFILE):
+    # mode: 'default' (500/file) | 'from_excel' | 'manual' (needs range=(from, to))
+    # progress(event, **data) gets 'stage', 'plan', 'file' and 'code' events;
+    # cancel is a threading.Event checked between output files (raises JobCancelled).
+    # out_root replaces OUTPUT_DIR so concurrent jobs can each write into their own folder.
+    # merge: None (one PDF per chunk) | 'code' (one PDF per code) | 'job' (one PDF for the whole run)
+    # order_cache: directory for the parsed-order pickle cache (see load_orders)
+    # dry_run: only plan; the result carries plan=[rows] (see plan_outputs) and no PDF is written
+    # max_pages: cap on pages per ColorLabel file; larger ranges are split (see cap_jobs)
+    # backend: PDF writer, 'reportlab' | 'fitz' (vector ColorLabels always use fitz)
+    # pdf may also be a directory or a list of PDFs; index_cache: persistent text index dir (see open_pdf)
+    # encoding: ENCODE_PROFILES name; dpi=None takes the profile's DPI
+    out_root = out_root or OUTPUT_DIR
+    merge = merge if merge in ('code', 'job') else None
+    export_mode = export if export in ('color','hangtag','both') else 'both'
+    manual_range = tuple(range) if (mode == 'manual' and range) else None
+    from_excel = (mode == 'from_excel')
+    selected = ','.join(codes) if isinstance(codes, (list, tuple)) else (codes or 'all')
+    workers = max(1, int(workers or 1))
+    backend = backend if backend in OUTPUT_BACKENDS else 'reportlab'
+    encoding = encoding if encoding in ENCODE_PROFILES else DEFAULT_PROFILE
+    dpi = int(dpi or encode_profile(encoding)['dpi'])
+
+    print('='*54); print(f'  XUAT TEM NHAN (v{VERSION})'); print('='*54)
+    print(f'Excel: {_source_label(excel)}'); print(f'PDF  : {_source_label(pdf)}'); print(f'DPI  : {dpi}'); print(f'Encoding: {encoding}')
+    print(f'Export: {export_mode}'); print(f'Render: {render}'); print(f'Backend: {backend}'); print(f'Workers: {workers}'); print(f'Selected: {selected}')
+    print(f'Output: {out_root}')
+    if incremental: print(f'Incremental: {os.path.join(out_root, MANIFEST_NAME)}')
+    if manual_range: print(f'Manual range: {manual_range[0]}-{manual_range[1]}')
+    if merge: print(f'Merge: {merge}')
+    if dry_run: print('Plan: dry-run (khong xuat PDF)')
+    if max_pages: print(f'Max pages/file: {max_pages}')
+    if merge and max_pages:
+        print('Luu y: --merge gop vao 1 file, bo qua --max-pages.'); max_pages = None
+    if merge and incremental:
+        print('Luu y: --merge ghi lai toan bo file gop, bo qua --incremental.'); incremental = False
+    if merge == 'job' and workers > 1:
+        print('Luu y: --merge=job ghi 1 file duy nhat, chay 1 worker.'); workers = 1
+    print('='*54)
+    if not dry_run: ensure_dir(out_root)
+
+    t0 = time.perf_counter()
+    df = excel if (isinstance(excel, pd.DataFrame) and 'qty_int' in excel.columns) else load_orders(excel, cache_dir=order_cache)
+    _emit(progress, 'stage', name='load', seconds=time.perf_counter() - t0)
+    if df is None: return None
 
     if selected != 'all':
         want = [re.sub(r'[^A-Z0-9]', '', s.upper()) for s in str(selected).split(',') if str(s).strip()]
         df = df[df['code_norm'].isin(want)]
         if df.empty:
-            print(f'Khong tim thay ma: {selected}'); return
-
-    doc = fitz.open(PDF_FILE)
+            print(f'Khong tim thay ma: {selected}'); return None
 
+    t0 = time.perf_counter()
     mode_tag = 'from_excel' if from_excel else 'default'
-    if manual_range:
-        for code, df_group in df.groupby('code_norm', sort=False):
-            print(f'-- Manual range cho mã: {code}')
-            process_group(doc, df_group, export_mode, DEFAULT_DPI, manual_range=manual_range, mode_tag=mode_tag)
-        print('[OK] Xuất Tự điền khoảng số (mỗi mã 1 file).'); return
-
+    plans = []
     for code, df_group in df.groupby('code_norm', sort=False):
-        process_group(doc, df_group, export_mode, DEFAULT_DPI, manual_range=None, mode_tag=mode_tag)
+        header = f'-- Manual range cho mã: {code}' if manual_range else None
+        code, jobs = plan_group(df_group, export_mode, manual_range=manual_range, mode_tag=mode_tag)
+        plans.append((code, cap_jobs(jobs, max_pages), header))
+    if dry_run:
+        doc = open_pdf(pdf, index_cache=index_cache)
+        try:
+            rows = plan_outputs(doc, plans, dpi=dpi, render=render, merge=merge, out_root=out_root)
+        finally:
+            if doc is not pdf: close_pdf(doc)   # only what open_pdf opened here; a caller's document stays open
+        _emit(progress, 'stage', name='plan', seconds=time.perf_counter() - t0)
+        print_plan(rows)
+        missing = sorted({r['code'] for r in rows if r['status'] == 'missing'})
+        return dict(codes=[code for code, _, _ in plans], failed=missing, out_root=out_root, plan=rows)
+    manifest = RunManifest(out_root) if incremental else None
+    _emit(progress, 'stage', name='plan', seconds=time.perf_counter() - t0)
+    _emit(progress, 'plan', codes=len(plans),
+          files=sum(1 for _, jobs, _ in plans for j in jobs if j['kind'] != 'skip'),
+          labels=sum(j['end'] - j['start'] + 1 for _, jobs, _ in plans for j in jobs if j['kind'] == 'color'))
 
-    if from_excel:
+    t0 = time.perf_counter()
+    failed = []
+    if workers > 1:
+        failed = run_parallel(_pool_source(pdf), plans, dpi, render, workers, manifest=manifest,
+                              progress=progress, cancel=cancel, out_root=out_root, merge=merge, backend=backend,
+                              index_cache=index_cache, encoding=encoding)
+        if failed: print(f'LOI: {len(failed)} ma that bai: {", ".join(failed)}')
+    else:
+        doc = open_pdf(pdf, index_cache=index_cache)
+        try:
+            merged = (MergedWriter(os.path.join(out_root, merged_filename()), render=render, nested=True, backend=backend,
+                                   encoding=encoding)
+                      if merge == 'job' else None)
+            for i, (code, jobs, header) in enumerate(plans):
+                _check_cancel(cancel)
+                if header: print(header)
+                if merge == 'code':
+                    run_code_merged(doc, code, jobs, dpi, render=render, progress=progress, cancel=cancel, out_root=out_root,
+                                    backend=backend, encoding=encoding)
+                else:
+                    run_group_jobs(doc, code, jobs, dpi, render=render, manifest=manifest, progress=progress, cancel=cancel,
+                                   out_root=out_root, merged=merged, backend=backend, encoding=encoding)
+                _emit(progress, 'code', code=code, done=i + 1, total=len(plans))
+            if merged is not None:
+                out_path = merged.close()
+                if out_path: _emit(progress, 'file', code=None, kind='merged', path=out_path, labels=0)
+        finally:
+            if doc is not pdf: close_pdf(doc)
+    _emit(progress, 'stage', name='export', seconds=time.perf_counter() - t0)
+    if manifest is not None: report_stale(manifest, plans, all_codes=(selected == 'all'))
+
+    if manual_range:
+        print('[OK] Xuất Tự điền khoảng số (mỗi mã 1 file).')
+    elif from_excel:
         print('[OK] Xuất theo khoảng từ Excel (mỗi mã 1 thư mục, mỗi dòng 1 file, chạy nối tiếp).')
     else:
         print('[OK] Mặc định: tự tách file 500 tem (mỗi mã 1 thư mục).')
+    return dict(codes=[code for code, _, _ in plans], failed=failed, out_root=out_root)
+
+WATCH_POLL_S = 2.0
+
+def _ready_files(inbox, exts, seen):
+    # (ready, settling): files whose size and mtime did not change since the previous poll, i.e. fully
+    # copied, and the ones that are new or still changing
+    ready = []; settling = []
+    for name in sorted(os.listdir(inbox)):
+        path = os.path.join(inbox, name)
+        if name.startswith('~$') or not name.lower().endswith(exts) or not os.path.isfile(path): continue
+        st = os.stat(path); sig = (st.st_size, st.st_mtime_ns)
+        (ready if seen.get(path) == sig else settling).append(path)
+        seen[path] = sig
+    return ready, settling
+
+def _move_into(path, folder):
+    ensure_dir(folder)
+    dest = os.path.join(folder, os.path.basename(path))
+    os.replace(path, dest)
+    return dest
+
+def _unique_dir(path):
+    # done/<time>_<name> repeats when the same name is dropped twice within a second: add _2, _3, ...
+    candidate, n = path, 1
+    while os.path.exists(candidate):
+        n += 1; candidate = f'{path}_{n}'
+    return candidate
+
+def watch_inbox(inbox, done_dir=None, failed_dir=None, poll=WATCH_POLL_S, once=False, **options):
+    # Daemon mode: one warm process instead of a cold start per order.
+    # Every `poll` seconds: .pdf drops form the source set, which stays open with its page index,
+    # rendered crops and fonts across jobs; each new .xlsx is one generate() run (options as for generate).
+    # PDFs that settle in different polls join the same set until an order has run against it; the next
+    # drop after that starts a new set. Orders wait while any .pdf in the inbox is still being copied.
+    # Inputs are moved to done/<time>_<name>[_N]/ (with run_report.json) or failed/ (with the traceback,
+    # or a note when generate() returned nothing, e.g. missing columns).
+    # once: stop when the inbox has nothing left to do.
+    import shutil, traceback
+    done_dir = done_dir or os.path.join(inbox, 'done')
+    failed_dir = failed_dir or os.path.join(inbox, 'failed')
+    ensure_dir(inbox); warm_fonts()
+    seen = {}; doc = None; sources = []; used = False; idle = 0; waiting = None
+    print(f'[WATCH] Theo doi {os.path.abspath(inbox)} (moi {poll:g}s, Ctrl+C de dung)')
+    try:
+        while True:
+            pdfs, copying = _ready_files(inbox, ('.pdf',), seen)
+            orders, _ = _ready_files(inbox, ('.xlsx',), seen)
+            if pdfs:
+                if used: sources = []; used = False
+                src_dir = _unique_dir(os.path.join(done_dir, time.strftime('%Y%m%d_%H%M%S') + '_pdf'))
+                sources += [_move_into(p, src_dir) for p in pdfs]
+                for p in pdfs: seen.pop(p, None)
+                if doc is not None: close_pdf(doc)
+                doc = open_pdf(sources[0] if len(sources) == 1 else sources, index_cache=options.get('index_cache'))
+                print(f'[WATCH] Nguon PDF: {", ".join(os.path.basename(f) for f in sources)} ({len(doc)} trang)')
+            hold = None
+            if orders and copying: hold = 'copying'
+            elif orders and doc is None: hold = 'no_pdf'
+            if hold and hold != waiting:
+                print('[WATCH] Co Excel, dang cho PDF chep xong...' if hold == 'copying'
+                      else '[WATCH] Co Excel nhung chua co PDF nguon, dang cho...')
+            waiting = hold
+            if hold: orders = []
+            for xlsx in orders:
+                seen.pop(xlsx, None)
+                job_dir = _unique_dir(os.path.join(done_dir, time.strftime('%Y%m%d_%H%M%S') + '_'
+                                                   + os.path.splitext(os.path.basename(xlsx))[0]))
+                moved = _move_into(xlsx, job_dir)
+                t0 = time.perf_counter()
+                used = True
+                try:
+                    result = generate(moved, doc, profile=os.path.join(job_dir, REPORT_NAME), **options)
+                    if result is None: raise ValueError('generate() khong chay (thieu cot bat buoc hoac khong co ma)')
+                    print(f'[WATCH] {os.path.basename(xlsx)}: {len(result["codes"])} ma, '
+                          f'{time.perf_counter() - t0:.1f}s -> {job_dir}')
+                except Exception:
+                    dest = _move_into(moved, failed_dir)
+                    shutil.rmtree(job_dir, ignore_errors=True)   # only the profile of the failed run is left there
+                    with open(dest + '.log', 'w', encoding='utf-8') as f: f.write(traceback.format_exc())
+                    print(f'[WATCH] LOI {os.path.basename(xlsx)} -> {dest}.log')
+            idle = 0 if (pdfs or orders or copying) else idle + 1
+            # two quiet polls: anything still in the inbox is either being copied or waiting for a PDF
+            if once and idle >= 2: break
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        print('\n[WATCH] Dung.')
+    finally:
+        if doc is not None: close_pdf(doc)
+
+def parse_run_options(argv_full):
+    # generate() keyword arguments from the --flags; returns (options, plan_out)
+    export_mode = 'both'
+    for a in argv_full:
+        if a.startswith('--export='):
+            v = a.split('=',1)[1].strip().lower()
+            if v in ('color','hangtag','both'): export_mode = v
+    render = 'raster'
+    for a in argv_full:
+        if a.startswith('--render='):
+            v = a.split('=',1)[1].strip().lower()
+            if v in ('raster','vector'): render = v
+    backend = 'reportlab'
+    for a in argv_full:
+        if a.startswith('--backend='):
+            v = a.split('=',1)[1].strip().lower()
+            if v in OUTPUT_BACKENDS: backend = v
+    encoding = DEFAULT_PROFILE
+    for a in argv_full:
+        if a.startswith('--encode='):
+            v = a.split('=',1)[1].strip().lower()
+            if v in ENCODE_PROFILES: encoding = v
+    workers = 1
+    for a in argv_full:
+        if a.startswith('--workers='):
+            try: workers = max(1, int(a.split('=',1)[1].strip()))
+            except ValueError: pass
+    incremental = ('--incremental' in argv_full)
+    merge = None
+    for a in argv_full:
+        if a == '--merge': merge = 'job'
+        elif a.startswith('--merge='):
+            v = a.split('=',1)[1].strip().lower()
+            if v in ('code','job'): merge = v
+    order_cache = ORDER_CACHE_DIR if '--order-cache' in argv_full else None
+    index_cache = None if '--no-index-cache' in argv_full else PDF_INDEX_DIR
+    plan_out = None   # --plan prints the plan; --plan=FILE.json|FILE.csv also saves it
+    profile = cprofile = None   # --profile[=FILE.json], --cprofile[=FILE.prof]
+    max_pages = None
+    for a in argv_full:
+        if a == '--plan': plan_out = ''
+        elif a.startswith('--plan='): plan_out = a.split('=',1)[1].strip()
+        elif a == '--profile': profile = True
+        elif a.startswith('--profile='): profile = a.split('=',1)[1].strip() or True
+        elif a == '--cprofile': cprofile = True
+        elif a.startswith('--max-pages='):
+            try: max_pages = max(0, int(a.split('=',1)[1].strip())) or None
+            except ValueError: pass
+        elif a.startswith('--cprofile='): cprofile = a.split('=',1)[1].strip() or True
+
+    manual_from, manual_to = parse_manual_range(argv_full)
+    manual_range = (manual_from, manual_to) if (manual_from and manual_to) else None
+    mode = 'manual' if manual_range else ('from_excel' if '--range-from-excel' in argv_full else 'default')
+
+    options = dict(mode=mode, export=export_mode, range=manual_range, render=render, workers=workers,
+                   incremental=incremental, merge=merge, order_cache=order_cache, dry_run=plan_out is not None,
+                   max_pages=max_pages, backend=backend, index_cache=index_cache, profile=profile, cprofile=cprofile,
+                   encoding=encoding)
+    return options, plan_out
+
+def main():
+    # --watch=INBOX [--poll=SECONDS] [--once]: daemon mode, see watch_inbox
+    watch = next((a.split('=',1)[1].strip() for a in sys.argv[1:] if a.startswith('--watch=')), None)
+    if watch:
+        options, _ = parse_run_options(sys.argv[1:])
+        for key in ('dry_run', 'profile', 'cprofile'): options.pop(key)
+        poll = next((a.split('=',1)[1].strip() for a in sys.argv[1:] if a.startswith('--poll=')), WATCH_POLL_S)
+        try: poll = float(poll)
+        except ValueError: poll = None
+        if poll is None or not 0 < poll < float('inf'):
+            print('Cach dung: --watch=INBOX [--poll=SECONDS] [--once]  (--poll la so giay > 0, vd --poll=2.5)'); sys.exit(2)
+        watch_inbox(watch, poll=poll, once='--once' in sys.argv[1:], **options)
+        return
+    EXCEL_FILE, PDF_FILE, dpi, selected, argv_full = resolve_args(sys.argv)
+    options, plan_out = parse_run_options(argv_full)
+    result = generate(EXCEL_FILE, PDF_FILE, codes=selected, dpi=dpi, **options)
+    if plan_out and result: write_plan(result['plan'], plan_out)
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,70 @@
 # label_app.py — v2.12.5
 import streamlit as st
-import subprocess, os, tempfile, shutil, sys
+import subprocess, os, sys, json, time, hashlib, contextlib
+import generate_labels_all as gla
+import label_jobs
 
-PYTHON_SCRIPT = "generate_labels_all.py"
-OUTPUT_DIR = "output_pdfs"
+# Parsed inputs live across reruns/sessions, keyed by the upload's content hash.
+@st.cache_resource(show_spinner=False)
+def cached_pdf(digest, _data):
+    # several uploads are opened as one document; their page texts persist in the on-disk index
+    return gla.open_pdf(_data, index_cache=gla.PDF_INDEX_DIR)
+
+@st.cache_resource(show_spinner=False)
+def cached_orders(digest, _data):
+    return gla.load_orders(_data, cache_dir=gla.ORDER_CACHE_DIR)
+
+# The cached document is shared by every session and by the jobs running on it (fitz is not
+# thread-safe): app-side calls hold gla.doc_lock, waiting at most DOC_WAIT_S for a running job.
+DOC_WAIT_S = 2.0
+
+@contextlib.contextmanager
+def using_doc(doc, wait=DOC_WAIT_S):
+    # yields False if the document stayed busy
+    lock = gla.doc_lock(doc)
+    got = lock.acquire(timeout=wait)
+    try:
+        yield got
+    finally:
+        if got: lock.release()
+
+# Thumbnails per (PDF upload hashes, code, planned job); a few ms each, so no button is needed.
+# TimeoutError (not cached) when a job holds the document.
+@st.cache_data(show_spinner=False, max_entries=500)
+def cached_preview(digest, code, job_key, _doc, _job):
+    with using_doc(_doc) as free:
+        if not free: raise TimeoutError
+        return gla.preview_label(_doc, code, job=_job)
+
+@st.cache_resource(show_spinner=False)
+def cached_fonts():
+    return gla.warm_fonts()
+
+# One queue for the whole server, shared by every browser session.
+@st.cache_resource(show_spinner=False)
+def job_queue():
+    return label_jobs.JobQueue()
+
+@st.cache_resource(show_spinner=False)
+def download_server():
+    # on the interface Streamlit listens on (server.address; unset = all); None if nothing could be bound
+    try:
+        return job_queue().serve_downloads(host=st.get_option("server.address") or "")
+    except OSError:
+        return None
+
+def download_url(job):
+    # same host the browser used for the app; LABEL_DOWNLOAD_URL overrides it behind a proxy
+    base = os.environ.get("LABEL_DOWNLOAD_URL")
+    if not base:
+        server = download_server()
+        if server is None: return None
+        host = (st.context.headers.get("Host") or "localhost").rsplit(":", 1)[0]
+        base = f"http://{host}:{server.server_address[1]}"
+    return f"{base.rstrip('/')}/{job.id}/{job.token}/{os.path.basename(job.zip_path)}"
+
+def upload_digest(f):
+    return hashlib.sha1(f.getvalue()).hexdigest()
 
 st.set_page_config(page_title="Tem Nhãn Tân Hòa (v2.12.5)", layout="centered")
 st.title("🏷️ Trình Xuất Tem Nhãn Tân Hòa (v2.12.5)")
@@ -11,15 +72,10 @@ st.title("🏷️ Trình Xuất Tem Nhãn Tân Hòa (v2.12.5)")
 st.markdown("---")
 st.header("📂 Chọn file đầu vào")
 uploaded_excel = st.file_uploader("Tải file Excel (.xlsx):", type=["xlsx"])
-uploaded_pdf = st.file_uploader("Tải file PDF (.pdf):", type=["pdf"])
+uploaded_pdfs = st.file_uploader("Tải file PDF (.pdf, có thể chọn nhiều file):", type=["pdf"],
+                                 accept_multiple_files=True)
 
-excel_path = None; pdf_path = None
-if uploaded_excel:
-    t = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-    t.write(uploaded_excel.read()); t.flush(); excel_path = t.name
-if uploaded_pdf:
-    t = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    t.write(uploaded_pdf.read()); t.flush(); pdf_path = t.name
+cached_fonts()
 
 st.markdown("---")
 mode = st.radio("⚙️ Cách lấy khoảng:", [
@@ -30,6 +86,15 @@ mode = st.radio("⚙️ Cách lấy khoảng:", [
 
 export_mode = st.radio("Chọn loại tem cần xuất:", ["Xuất ColorLabel (đỏ)", "Xuất Hangtag (xanh)", "Xuất cả 2"], index=0)
 
+merge_mode = st.radio("🖨️ Gộp file in:", ["Không gộp (mỗi 500 tem 1 file)", "Gộp mỗi mã 1 file", "Gộp cả job 1 file"], index=0)
+backend = st.radio("🧰 Bộ ghi PDF:", ["reportlab", "fitz (PyMuPDF)"], index=0, horizontal=True)
+encoding = st.radio("🗜️ Chất lượng ảnh:", list(gla.ENCODE_PROFILES), horizontal=True,
+                    index=list(gla.ENCODE_PROFILES).index(gla.DEFAULT_PROFILE),
+                    format_func=lambda name: f"{name} ({gla.ENCODE_PROFILES[name]['dpi']} dpi)")
+max_pages = 0
+if merge_mode.startswith("Không gộp"):
+    max_pages = st.number_input("📄 Tối đa trang / file (0 = không giới hạn):", min_value=0, value=0, step=50)
+
 mode2 = st.radio("🎯 Chế độ chọn mã:", ["Xuất tất cả mã", "Xuất mã cụ thể"], index=0)
 codes = ""
 if mode2 == "Xuất mã cụ thể":
@@ -43,60 +108,188 @@ if mode == "Tự điền khoảng số":
     with c2:
         manual_to = st.number_input("Đến số (inclusive)", min_value=1, value=100, step=1)
 
-run1, run2 = st.columns([1,1])
+run1, run2, run3 = st.columns([1,1,1])
 with run1:
     run_button = st.button("🚀 BẮT ĐẦU XUẤT TEM")
 with run2:
+    plan_button = st.button("🔍 Xem trước kế hoạch")
+with run3:
     open_button = st.button("📂 Mở thư mục output")
 
 if open_button:
-    try:
-        if not os.path.exists(OUTPUT_DIR):
-            os.makedirs(OUTPUT_DIR, exist_ok=True)
-        if os.name == "nt":
-            os.startfile(OUTPUT_DIR)
-        elif sys.platform == "darwin":
-            subprocess.Popen(["open", OUTPUT_DIR])
-        else:
-            subprocess.Popen(["xdg-open", OUTPUT_DIR])
-    except Exception as e:
-        st.error(f"Không mở được thư mục: {e}")
+    # each job has its own output folder; open the one from this session's last job
+    current = job_queue().get(st.session_state.get("job_id", ""))
+    if current is None:
+        st.warning("Chưa có job nào trong phiên này.")
+    else:
+        try:
+            os.makedirs(current.out_root, exist_ok=True)
+            if os.name == "nt":
+                os.startfile(current.out_root)
+            elif sys.platform == "darwin":
+                subprocess.Popen(["open", current.out_root])
+            else:
+                subprocess.Popen(["xdg-open", current.out_root])
+        except Exception as e:
+            st.error(f"Không mở được thư mục: {e}")
 
-if run_button:
-    if not uploaded_excel or not uploaded_pdf:
+def run_kwargs():
+    # generate() arguments for the current controls; stops the script on invalid input
+    if not uploaded_excel or not uploaded_pdfs:
         st.error("⚠️ Vui lòng tải cả file Excel và file PDF!")
-    else:
-        cmd = ["python", PYTHON_SCRIPT, os.path.basename(uploaded_excel.name), os.path.basename(uploaded_pdf.name)]
-        if mode == "Lấy khoảng theo Excel (chạy nối tiếp)":
-            cmd += ["--range-from-excel"]
-        elif mode == "Tự điền khoảng số":
-            if not (manual_from and manual_to and manual_from <= manual_to):
-                st.error("Vui lòng nhập khoảng hợp lệ (Từ <= Đến).")
-                st.stop()
-            cmd.append(f"--manual-range={int(manual_from)}-{int(manual_to)}")
-
-        if export_mode == "Xuất ColorLabel (đỏ)":
-            cmd += ["--export=color"]
-        elif export_mode == "Xuất Hangtag (xanh)":
-            cmd += ["--export=hangtag"]
+        st.stop()
+    kwargs = dict(mode="default", export="both", codes="all", range=None)
+    if mode == "Lấy khoảng theo Excel (chạy nối tiếp)":
+        kwargs["mode"] = "from_excel"
+    elif mode == "Tự điền khoảng số":
+        if not (manual_from and manual_to and manual_from <= manual_to):
+            st.error("Vui lòng nhập khoảng hợp lệ (Từ <= Đến).")
+            st.stop()
+        kwargs["mode"] = "manual"
+        kwargs["range"] = (int(manual_from), int(manual_to))
+
+    if export_mode == "Xuất ColorLabel (đỏ)":
+        kwargs["export"] = "color"
+    elif export_mode == "Xuất Hangtag (xanh)":
+        kwargs["export"] = "hangtag"
+
+    if mode2 == "Xuất mã cụ thể" and codes.strip():
+        kwargs["codes"] = codes.strip()
+
+    if merge_mode == "Gộp mỗi mã 1 file":
+        kwargs["merge"] = "code"
+    elif merge_mode == "Gộp cả job 1 file":
+        kwargs["merge"] = "job"
+    if max_pages:
+        kwargs["max_pages"] = int(max_pages)
+    if backend.startswith("fitz"):
+        kwargs["backend"] = "fitz"
+    if encoding != gla.DEFAULT_PROFILE:
+        kwargs["encoding"] = encoding
+
+    orders = cached_orders(upload_digest(uploaded_excel), uploaded_excel.getvalue())
+    if orders is None:
+        st.error("❌ Không tìm thấy các cột bắt buộc (Code/QTY/Số lượng) trong Excel.")
+        st.stop()
+    datas = [f.getvalue() for f in uploaded_pdfs]
+    doc = cached_pdf(tuple(upload_digest(f) for f in uploaded_pdfs), datas[0] if len(datas) == 1 else datas)
+    return dict(excel=orders, pdf=doc, **kwargs)
+
+if plan_button:
+    kwargs = run_kwargs()
+    with using_doc(kwargs["pdf"]) as free:
+        if not free:
+            st.warning("⏳ Đang có job chạy trên file PDF này, vui lòng xem trước sau khi job xong.")
         else:
-            cmd += ["--export=both"]
+            with st.spinner("Đang lập kế hoạch..."):
+                result = gla.generate(dry_run=True, **kwargs)
+            st.session_state["plan"] = result["plan"] if result else None
 
-        if mode2 == "Xuất mã cụ thể" and codes.strip():
-            cmd.append(codes.strip())
+if run_button:
+    kwargs = run_kwargs()
+    try:
+        job = job_queue().submit(kwargs, label=f"{uploaded_excel.name} / {', '.join(f.name for f in uploaded_pdfs)}")
+        st.session_state["job_id"] = job.id
+        st.session_state.pop("plan", None)
+    except label_jobs.QueueFull as e:
+        st.error(f"⛔ Máy chủ đang bận ({e}). Vui lòng thử lại sau.")
 
-        if excel_path: shutil.copy(excel_path, os.path.basename(uploaded_excel.name))
-        if pdf_path:   shutil.copy(pdf_path, os.path.basename(uploaded_pdf.name))
+plan = st.session_state.get("plan")
+if plan:
+    st.markdown("---")
+    st.subheader("🔍 Kế hoạch xuất (chưa render)")
+    ok = [r for r in plan if r["status"] in ("ok", "warn")]
+    m1, m2, m3 = st.columns(3)
+    m1.metric("File", len({r["file"] for r in ok}))
+    m2.metric("Trang", sum(r["pages"] for r in ok))
+    m3.metric("Ước tính", f"{sum(r['est_bytes'] for r in ok) / 1048576:.1f} MB")
+    missing = sorted({r["code"] for r in plan if r["status"] == "missing"})
+    if missing:
+        st.error(f"Không thấy trong PDF ({len(missing)}): {', '.join(missing)}")
+    bad = [r["note"] for r in plan if r["status"] in ("skip", "warn")]
+    if bad:
+        st.warning("\n".join(f"- {n}" for n in bad))
+    st.dataframe([{k: (os.path.basename(v) if k == "file" and v else v) for k, v in r.items()} for r in plan],
+                 use_container_width=True, hide_index=True)
 
-        st.info("⏳ Đang xử lý, vui lòng chờ...")
+if uploaded_excel and uploaded_pdfs:
+    orders = cached_orders(upload_digest(uploaded_excel), uploaded_excel.getvalue())
+    if orders is not None and not orders.empty:
+        st.markdown("---")
+        st.subheader("👁️ Xem nhanh tem")
+        preview_code = st.selectbox("Mã:", list(dict.fromkeys(orders["code_norm"].tolist())))
+        manual = (int(manual_from), int(manual_to)) if (mode == "Tự điền khoảng số" and manual_from and manual_to) else None
+        mode_tag = "from_excel" if mode == "Lấy khoảng theo Excel (chạy nối tiếp)" else "default"
+        _, jobs = gla.plan_group(orders[orders["code_norm"] == preview_code], "color", manual_range=manual, mode_tag=mode_tag)
+        first = next((j for j in jobs if j["kind"] == "color"), None)
+        digest = tuple(upload_digest(f) for f in uploaded_pdfs)
+        datas = [f.getvalue() for f in uploaded_pdfs]
+        doc = cached_pdf(digest, datas[0] if len(datas) == 1 else datas)
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            st.success("✅ Hoàn tất xuất tem!")
-            st.code(result.stdout)
-        except subprocess.CalledProcessError as e:
-            st.error("❌ Có lỗi khi chạy script.")
-            out = (e.stdout or "") + "\n\n" + (e.stderr or "")
-            st.code(out)
+            preview = cached_preview(digest, preview_code, tuple(sorted(first.items())) if first else None, doc, first)
+        except TimeoutError:
+            st.info("⏳ Đang có job chạy trên file PDF này, xem nhanh sau khi job xong.")
+        else:
+            if preview is None:
+                st.error(f"Không thấy mã {preview_code} trong PDF.")
+            else:
+                p1, p2 = st.columns([3, 1])
+                p1.image(preview["colorlabel"], caption=f"ColorLabel {first['start']}/{first['total']} • SL {first['qty']}"
+                         if first else "ColorLabel (không có dòng hợp lệ)", use_container_width=True)
+                p2.image(preview["hangtag"], caption=preview["week"], use_container_width=True)
+                src, page_no = preview["page"]
+                st.caption(f"Trang {page_no + 1} • {os.path.basename(src or '')} • dấu + xanh: vị trí BOX_REF/QTY_REF")
+
+job = job_queue().get(st.session_state.get("job_id", ""))
+if job is not None:
+    st.markdown("---")
+    st.subheader(f"📋 Job {job.id} — {job.label}")
+    st.caption(f"📁 {job.out_root}")
+    if job.status == "queued":
+        st.info(f"⏳ Đang chờ trong hàng đợi (vị trí {job_queue().position(job)})...")
+    st.progress(job.fraction(), text=f"{job.codes_done}/{job.codes_total} mã • "
+                                      f"{job.files_done}/{job.files_total} file • "
+                                      f"{job.labels_done}/{job.labels_total} tem • {job.elapsed():.1f}s")
+    if job.stages:
+        st.caption(" • ".join(f"{k}: {v:.2f}s" for k, v in job.stages.items()))
+    st.code(job.log() or "...")
+    if job.active:
+        if st.button("⛔ Hủy job"):
+            job.cancel()
+        time.sleep(1)
+        st.rerun()
+    elif job.status == "done":
+        st.success("✅ Hoàn tất xuất tem!")
+    elif job.status == "cancelled":
+        st.warning("Job đã bị hủy.")
+    elif job.status == "failed":
+        st.error(f"❌ Có lỗi khi chạy script: {job.error}")
+    if not job.active and job.zip_ready:
+        # the archive was built on disk while the job ran; the download endpoint streams it from there
+        size = f"{os.path.getsize(job.zip_path) / 1048576:.1f} MB"
+        url = download_url(job)
+        if url is None:
+            st.warning(f"Không mở được cổng tải file; lấy ZIP tại: {job.zip_path}")
+        elif job.status == "done":
+            st.link_button(f"⬇️ Tải ZIP output ({size})", url)
+        else:
+            st.link_button(f"⬇️ Tải ZIP CHƯA ĐỦ ({size}, chỉ các file đã xong)", url)
+    report = (job.result or {}).get("report")
+    if report:
+        opts = report["options"]
+        written = report["counters"].get("bytes_written", 0) / 1048576
+        encode_s = report["stages"].get("encode", {}).get("seconds", 0)
+        with st.expander(f"⏱️ Hiệu năng: {report['wall_seconds']:.1f}s • {opts.get('encoding')} {opts['dpi']} dpi • "
+                         f"{written:.1f} MB • encode {encode_s:.2f}s"):
+            stages = sorted(report["stages"].items(), key=lambda kv: -kv[1]["seconds"])
+            st.dataframe([{"stage": k, "giây": v["seconds"], "lần": v["calls"]} for k, v in stages],
+                         use_container_width=True, hide_index=True)
+            st.dataframe([{"chỉ số": k, "giá trị": v} for k, v in report["counters"].items()] +
+                         [{"chỉ số": k, "giá trị": v} for k, v in report["peaks"].items()],
+                         use_container_width=True, hide_index=True)
+            st.caption("peak_rss_mb là bộ nhớ đỉnh của cả tiến trình server, không riêng job này.")
+            st.download_button("⬇️ run_report.json", data=json.dumps(report, ensure_ascii=False, indent=1),
+                               file_name=f"run_report_{job.id}.json", mime="application/json")
 
 st.markdown("---")
 st.caption("• 'Mặc định': tự tách 500 tem / file theo từng dòng Excel. • 'Theo Excel': dùng From/To (nếu trống sẽ dồn nối tiếp). • 'Tự điền khoảng': 1 file/mã theo khoảng nhập tay.")
@@ -0,0 +1,240 @@
+# label_jobs.py — hàng đợi job chạy nền cho label_app (v2.12.5)
+import io, os, sys, time, uuid, shutil, secrets, zipfile, tempfile, threading, traceback, contextlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import generate_labels_all as gla
+
+MAX_RUNNING = int(os.environ.get('LABEL_MAX_JOBS', '1'))
+MAX_QUEUED = int(os.environ.get('LABEL_MAX_QUEUED', '4'))
+LOG_TAIL_CHARS = 20000
+# Each job writes into JOBS_ROOT/<job id>/output_pdfs; finished workspaces are removed after the TTL.
+JOBS_ROOT = os.environ.get('LABEL_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'tanhoa_label_jobs'))
+JOB_TTL_S = float(os.environ.get('LABEL_JOB_TTL_HOURS', '24')) * 3600
+# Finished archives are served from disk by a small HTTP endpoint next to the Streamlit server
+# (st.download_button reads the whole file into memory on every rerun). Streamlit itself moves on to
+# 8502, 8503, ... when 8501 is taken, so the endpoint stays clear of that range; if its port is in use
+# it falls back to a free one. Each link carries a per-job random token.
+DOWNLOAD_PORT = int(os.environ.get('LABEL_DOWNLOAD_PORT', '8599'))
+DOWNLOAD_CHUNK = 1 << 20
+
+class QueueFull(Exception):
+    pass
+
+class _ThreadStdout(io.TextIOBase):
+    # Routes print() from a job thread into that job's log; other threads keep the real stdout.
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.sinks = {}
+
+    def write(self, text):
+        sink = self.sinks.get(threading.get_ident())
+        return sink(text) if sink is not None else self.fallback.write(text)
+
+    def flush(self):
+        self.fallback.flush()
+
+_ROUTER = None
+_ROUTER_LOCK = threading.Lock()
+
+def _router():
+    global _ROUTER
+    with _ROUTER_LOCK:
+        if _ROUTER is None:
+            _ROUTER = _ThreadStdout(sys.stdout)
+            sys.stdout = _ROUTER
+    return _ROUTER
+
+class Job:
+    def __init__(self, kwargs, label=''):
+        self.id = uuid.uuid4().hex[:8]
+        self.label = label
+        self.workspace = os.path.join(JOBS_ROOT, self.id)
+        self.out_root = os.path.join(self.workspace, 'output_pdfs')
+        self.zip_path = os.path.join(self.workspace, f'output_{self.id}.zip')
+        self.token = secrets.token_urlsafe(16)   # download link secret, see JobQueue.serve_downloads
+        self._zip = None; self._zipped = set()
+        self.kwargs = dict(kwargs, out_root=self.out_root)
+        self.status = 'queued'   # queued | running | done | failed | cancelled
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.log_parts = []; self.log_len = 0
+        self.codes_total = 0; self.codes_done = 0
+        self.files_total = 0; self.files_done = 0
+        self.labels_total = 0; self.labels_done = 0
+        self.stages = {}
+        self.files = []
+        self.error = None
+        self.result = None
+        self.submitted = time.time(); self.started = None; self.finished = None
+
+    def write(self, text):
+        with self.lock:
+            self.log_parts.append(text); self.log_len += len(text)
+            if self.log_len > 4 * LOG_TAIL_CHARS:
+                tail = ''.join(self.log_parts)[-LOG_TAIL_CHARS:]
+                self.log_parts = [tail]; self.log_len = len(tail)
+        return len(text)
+
+    def log(self):
+        with self.lock:
+            return ''.join(self.log_parts)[-LOG_TAIL_CHARS:]
+
+    def _zip_add(self, path):
+        # PDFs are already deflated: store them; the archive grows on disk one entry per finished file
+        arcname = os.path.relpath(path, self.out_root).replace(os.sep, '/')
+        if arcname in self._zipped or not os.path.exists(path): return
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.zip_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._zip.write(path, arcname)
+        self._zipped.add(arcname)
+
+    def close_zip(self):
+        if self._zip is not None:
+            self._zip.close(); self._zip = None
+
+    @property
+    def zip_ready(self):
+        return self._zip is None and bool(self._zipped) and os.path.exists(self.zip_path)
+
+    def on_progress(self, event, **data):
+        if event == 'file': self._zip_add(data['path'])
+        with self.lock:
+            if event == 'plan':
+                self.codes_total = data['codes']; self.files_total = data['files']; self.labels_total = data['labels']
+            elif event == 'file':
+                self.files_done += 1; self.labels_done += data.get('labels', 0); self.files.append(data['path'])
+            elif event == 'labels':
+                self.labels_done += data['labels']
+            elif event == 'code':
+                self.codes_done = data['done']
+            elif event == 'stage':
+                self.stages[data['name']] = data['seconds']
+
+    def fraction(self):
+        if self.status == 'done': return 1.0
+        if self.labels_total: return min(1.0, self.labels_done / self.labels_total)
+        if self.codes_total: return min(1.0, self.codes_done / self.codes_total)
+        return 0.0
+
+    def elapsed(self):
+        if not self.started: return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def cancel(self):
+        self.cancel_event.set()
+
+class JobQueue:
+    # At most MAX_RUNNING jobs render at once; jobs on the same cached upload also take turns on its
+    # gla.doc_lock (fitz documents are not thread-safe). At most MAX_QUEUED wait, further submits raise QueueFull.
+    def __init__(self, max_running=MAX_RUNNING, max_queued=MAX_QUEUED):
+        self.max_running = max(1, max_running)
+        self.max_queued = max(0, max_queued)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_running, thread_name_prefix='label-job')
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def cleanup(self):
+        # drop finished jobs and their workspaces once they are older than JOB_TTL_S
+        now = time.time()
+        with self.lock:
+            expired = [j for j in self.jobs.values() if j.finished and now - j.finished > JOB_TTL_S]
+            for j in expired: del self.jobs[j.id]
+            live = {j.id for j in self.jobs.values()}
+        for j in expired: shutil.rmtree(j.workspace, ignore_errors=True)
+        # leftovers from earlier server runs
+        try:
+            for name in os.listdir(JOBS_ROOT):
+                path = os.path.join(JOBS_ROOT, name)
+                if name not in live and now - os.path.getmtime(path) > JOB_TTL_S:
+                    shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+    def submit(self, kwargs, label=''):
+        self.cleanup()
+        with self.lock:
+            queued = sum(1 for j in self.jobs.values() if j.status == 'queued')
+            running = sum(1 for j in self.jobs.values() if j.status == 'running')
+            if running >= self.max_running and queued >= self.max_queued:
+                raise QueueFull(f'{running} job đang chạy, {queued} job đang chờ')
+            job = Job(kwargs, label=label)
+            self.jobs[job.id] = job
+        self.pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def position(self, job):
+        with self.lock:
+            waiting = sorted((j for j in self.jobs.values() if j.status == 'queued'), key=lambda j: j.submitted)
+        return next((i + 1 for i, j in enumerate(waiting) if j is job), 0)
+
+    def serve_downloads(self, host='', port=DOWNLOAD_PORT):
+        # GET /<job id>/<job token>/<archive name> streams that job's finished ZIP. Returns the running
+        # server (port 0 = any free port if `port` is taken); raises OSError if nothing can be bound.
+        queue = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.split('?', 1)[0].strip('/').split('/')
+                job = queue.get(parts[0]) if len(parts) == 3 else None
+                if (job is None or not secrets.compare_digest(parts[1], job.token) or job.active or not job.zip_ready
+                        or parts[2] != os.path.basename(job.zip_path)):
+                    self.send_error(404); return
+                with open(job.zip_path, 'rb') as f:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/zip')
+                    self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                    self.send_header('Content-Disposition', f'attachment; filename="{parts[2]}"')
+                    self.end_headers()
+                    try: shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK)
+                    except (BrokenPipeError, ConnectionResetError): pass
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer((host, port), Handler)
+        except OSError:
+            if not port: raise
+            server = ThreadingHTTPServer((host, 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='label-downloads', daemon=True).start()
+        return server
+
+    def _run(self, job):
+        # the whole run holds the document's lock; the job stays 'queued' while it waits for it
+        pdf = job.kwargs.get('pdf')
+        with gla.doc_lock(pdf) if isinstance(pdf, gla.fitz.Document) else contextlib.nullcontext():
+            self._run_locked(job)
+
+    def _run_locked(self, job):
+        if job.cancel_event.is_set():
+            job.status = 'cancelled'; job.finished = time.time(); return
+        router = _router()
+        tid = threading.get_ident()
+        router.sinks[tid] = job.write
+        job.status = 'running'; job.started = time.time()
+        try:
+            os.makedirs(job.out_root, exist_ok=True)
+            job.result = gla.generate(progress=job.on_progress, cancel=job.cancel_event, **job.kwargs)
+            job.status = 'done'
+        except gla.JobCancelled:
+            job.write('\n[HUY] Job da bi huy.\n')
+            job.status = 'cancelled'
+        except Exception as e:
+            job.error = f'{type(e).__name__}: {e}'
+            job.write('\n' + traceback.format_exc())
+            job.status = 'failed'
+        finally:
+            try: job.close_zip()
+            except Exception as e: job.write(f'\n[ZIP] {type(e).__name__}: {e}\n')
+            job.finished = time.time()
+            router.sinks.pop(tid, None)
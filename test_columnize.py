@@ -0,0 +1,37 @@
+# test_columnize.py — columnize_rows (generator) vs the old list version, exhaustive over small ranges
+#   python -m pytest -q test_columnize.py
+import generate_labels_all as gla
+
+def legacy_columnize_rows(start_n, end_n):
+    # list version as it was before the lazy layout
+    total = max(0, end_n - start_n + 1)
+    if total <= 0: return []
+    base, rem = divmod(total, 4)
+    sizes = [base + (1 if i < rem else 0) for i in range(4)]
+    cols = []; cur = start_n
+    for s in sizes:
+        cols.append(list(range(cur, cur + s))); cur += s
+    maxlen = max(len(c) for c in cols) if cols else 0
+    rows = []
+    for r in range(maxlen):
+        rows.append([
+            cols[0][r] if r < len(cols[0]) else None,
+            cols[1][r] if r < len(cols[1]) else None,
+            cols[2][r] if r < len(cols[2]) else None,
+            cols[3][r] if r < len(cols[3]) else None,
+        ])
+    return rows
+
+def test_columnize_rows_matches_legacy():
+    # every start/end pair in a window wide enough to hit all rem values, empty and reversed ranges
+    for start_n in range(-3, 40):
+        for end_n in range(start_n - 3, start_n + 60):
+            rows = list(gla.columnize_rows(start_n, end_n))
+            assert rows == legacy_columnize_rows(start_n, end_n), (start_n, end_n)
+            assert len(rows) == gla.label_page_count(start_n, end_n), (start_n, end_n)
+
+def test_columnize_rows_large_range():
+    for start_n, end_n in ((1, 100000), (7, 100003), (1, 99999), (50001, 150000)):
+        rows = list(gla.columnize_rows(start_n, end_n))
+        assert rows == legacy_columnize_rows(start_n, end_n), (start_n, end_n)
+        assert sorted(n for row in rows for n in row if n is not None) == list(range(start_n, end_n + 1))
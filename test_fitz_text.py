@@ -0,0 +1,37 @@
+# test_fitz_text.py — text written by the fitz backend extracts as the same characters as reportlab's
+#   python -m pytest -q test_fitz_text.py
+import contextlib, io
+import fitz
+import PIL.Image as PilImage
+import pytest
+import generate_labels_all as gla
+
+WEEK = 'MER-C207001-W42'
+
+def quiet(fn, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+def words(path):
+    with fitz.open(path) as doc:
+        return [w[4] for page in doc for w in page.get_text('words')]
+
+@pytest.mark.parametrize('encoding', ['print', 'archive'])   # with and without font subsetting
+def test_hangtag_text_roundtrip(tmp_path, encoding):
+    out = {backend: words(quiet(gla.export_hangtag_generated, 'C207001', WEEK, str(tmp_path / backend),
+                                backend=backend, encoding=encoding))
+           for backend in gla.OUTPUT_BACKENDS}
+    assert out['fitz'].count(WEEK) == 36
+    assert sorted(out['fitz']) == sorted(out['reportlab'])
+
+def test_colorlabel_text_roundtrip(tmp_path):
+    jpeg = gla.encode_label_jpeg(PilImage.new('RGB', (40, 20), 'white'))
+    path = quiet(gla.export_chunk_colorlabel_fitz, 'C207001', 12, jpeg, 1, 10, 10, 'LSX', str(tmp_path))
+    assert sorted(words(path)) == sorted([f'{n:02d}/10' for n in range(1, 11)] + ['12'] * 10)
+
+def test_merged_text_roundtrip(tmp_path):
+    path = str(tmp_path / 'm.pdf')
+    writer = gla.MergedWriter(path, backend='fitz')
+    quiet(writer.add_hangtag, 'C207001', WEEK)
+    quiet(writer.close)
+    assert words(path).count(WEEK) == 36
@@ -0,0 +1,29 @@
+# test_page_digest.py — PageIndex.page_digest must see artwork that lives inside a form XObject
+#   python -m pytest -q test_page_digest.py
+import fitz
+import generate_labels_all as gla
+
+def artwork(fill):
+    src = fitz.open()
+    page = src.new_page(width=200, height=100)
+    page.draw_rect(fitz.Rect(10, 10, 190, 90), color=None, fill=fill)
+    return src
+
+def form_wrapped_doc(fills):
+    # every page: the same label text on top of an artwork page grafted by show_pdf_page (a form XObject)
+    doc = fitz.open()
+    for fill in fills:
+        page = doc.new_page(width=200, height=100)
+        page.show_pdf_page(page.rect, artwork(fill), 0)
+        page.insert_text((20, 50), 'C207001 MER-C207001-W42')
+    return doc
+
+def test_fill_inside_form_changes_digest():
+    index = gla.PageIndex(form_wrapped_doc([(1, 0, 0), (0, 0, 1)]))
+    assert index.page_digest(0) != index.page_digest(1)
+
+def test_same_artwork_same_digest():
+    # independent of xref numbering: two builds of the same page give the same digest
+    a = gla.PageIndex(form_wrapped_doc([(1, 0, 0)]))
+    b = gla.PageIndex(form_wrapped_doc([(0, 1, 0), (1, 0, 0)]))
+    assert a.page_digest(0) == b.page_digest(1)